@@ -0,0 +1,387 @@
+"""Нагрузочный бенчмарк: синтетические базы, все эндпоинты, тестовый клиент Flask и живой сервер.
+
+  python benchmark.py                          # 1k и 100k записей, результат в benchmark-results.json
+  python benchmark.py --sizes 1k,100k,1m       # + миллион (долго, несколько ГБ памяти)
+  python benchmark.py --sizes 1k --compare old.json
+
+Каждый размер — отдельный процесс (честные время старта и RSS). Результат —
+JSON: p50/p95/p99/среднее (мс) и запросов в секунду по каждому эндпоинту,
+RSS и время старта; --compare печатает отношения к прошлому прогону.
+"""
+import argparse, json, os, platform, random, shutil, socket, struct, subprocess, sys, tempfile, threading, time, zlib
+import urllib.error, urllib.parse, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SEED = 20240101
+
+WORDS = (
+    "изделие изделия маркировка маркировки упаковка упаковки транспортирование хранение "
+    "предприятие-изготовитель товарный знак наименование обозначение дата изготовления "
+    "номинальные параметры напряжение ток мощность частота корпус крышка ящик контейнер "
+    "сопроводительный документ паспорт руководство эксплуатации требования безопасности "
+    "испытания приёмка контроль образцы партия поверхность покрытие трубы насосы фильтры "
+    "двигатели холодильники стиральные машины светильники кабели провода соединители "
+    "вилки розетки выключатели трансформаторы аккумуляторы батареи электроды изоляция "
+    "климатическое исполнение температура влажность вибрация удар прочность герметичность "
+    "полиэтилен сталь стекло алюминий медь резина пластмасса бумага картон древесина"
+).split()
+NOUNS = ("Изделия", "Насосы", "Фильтры", "Трубы", "Светильники", "Кабели", "Трансформаторы",
+         "Холодильники", "Двигатели", "Аккумуляторы", "Выключатели", "Контейнеры")
+PREFIXES = ("ГОСТ", "ГОСТ", "ГОСТ", "ГОСТ Р", "ГОСТ IEC", "ГОСТ ISO")
+
+
+def parse_size(s):
+    s = s.strip().lower()
+    mult = {"k": 1000, "m": 1000000}.get(s[-1:], 1)
+    return int(float(s.rstrip("km")) * mult)
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def gost_number(i):
+    return f"{PREFIXES[i % len(PREFIXES)]} {10000 + i}-{1980 + i % 45}"
+
+
+def generate(n, path):
+    """gost_data.json и tnved_data.json по n записей: русский текст пунктов, 10-значные коды."""
+    rng = random.Random(SEED + n)
+    gosts = {}
+    for i in range(n):
+        clauses = " ".join(
+            f"п.{rng.randint(1, 9)}.{rng.randint(1, 20)} {rng.choice(NOUNS)} {sentence(rng, rng.randint(8, 30))}."
+            for _ in range(rng.randint(1, 6)))
+        gosts[gost_number(i)] = {"text": clauses, "mark": sentence(rng, rng.randint(3, 12)).capitalize()}
+    names = [f"{rng.choice(NOUNS)} {sentence(rng, rng.randint(4, 14))}" for _ in range(max(1, n // 5))]
+    tnved = {}
+    while len(tnved) < n:
+        code = f"{rng.randint(1, 97):02d}{rng.randint(0, 99999999):08d}"
+        tnved[code] = {
+            "name": rng.choice(names),       # в настоящей базе наименования тоже повторяются
+            "sector": f"Y.{rng.randint(1, 20):02d}.",
+            "object_code": f"MS.{rng.randint(1, 99)}",
+            "standards": [gost_number(rng.randrange(n)) for _ in range(rng.randint(1, 4))],
+        }
+    os.makedirs(path, exist_ok=True)
+    for name, data in (("gost_data.json", gosts), ("tnved_data.json", tnved)):
+        with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+    shutil.copy(os.path.join(ROOT, "regulation.json"), path)
+    return list(gosts)[:2000], list(tnved)[:2000]
+
+
+def png_pixel():
+    """PNG 1×1 без Pillow — тело для загрузки картинки."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00\xff\xff\xff")) + chunk(b"IEND", b""))
+
+
+class Raw:
+    """Тело запроса не в JSON: готовые байты и их Content-Type."""
+
+    def __init__(self, content_type, data):
+        self.content_type, self.data = content_type, data
+
+    @classmethod
+    def ndjson(cls, records):
+        return cls("application/x-ndjson",
+                   "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8"))
+
+    @classmethod
+    def multipart(cls, fields, files):
+        """fields: {имя: строка}; files: {имя: (имя файла, байты)}."""
+        boundary = "bench" + os.urandom(8).hex()
+        parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode("utf-8")
+                 for k, v in fields.items()]
+        for k, (filename, data) in files.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"; filename="{filename}"\r\n'
+                         f"Content-Type: application/octet-stream\r\n\r\n".encode("utf-8") + data + b"\r\n")
+        return cls(f"multipart/form-data; boundary={boundary}", b"".join(parts) + f"--{boundary}--\r\n".encode())
+
+
+def encode(body):
+    """(байты, Content-Type) тела запроса: Raw как есть, остальное — JSON."""
+    if body is None:
+        return None, None
+    if isinstance(body, Raw):
+        return body.data, body.content_type
+    return json.dumps(body).encode("utf-8"), "application/json"
+
+
+def scenario(gosts, codes, rng):
+    """[(имя, метод, url, тело)] — по одному генератору запросов на эндпоинт."""
+    reg_codes = json.load(open(os.path.join(ROOT, "regulation.json"), encoding="utf-8")).get("tnved_codes", ["8418102001"])
+    counter = iter(range(10 ** 9))
+    added = []      # удаляем то, что добавил add_gost, — исходная база не худеет
+    image = png_pixel()
+
+    def add_gost():
+        number = f"ГОСТ Б{next(counter)}-{rng.randint(1990, 2024)}"
+        added.append(number)
+        return ("POST", "/api/add-gost", {"gost_number": number, "gost_mark": sentence(rng, 4),
+                                          "gost_text": sentence(rng, 40)})
+
+    def delete_gost():
+        number = added.pop() if added else f"ГОСТ Б{next(counter)}-1990"
+        return ("GET", "/api/delete-gost/" + q(number), None)
+
+    return [
+        ("index", lambda: ("GET", "/", None)),
+        ("search_word", lambda: ("GET", "/api/search?q=" + q(rng.choice(WORDS)), None)),
+        ("search_number", lambda: ("GET", "/api/search?q=" + q(rng.choice(gosts).split()[-1]), None)),
+        ("tnved_code", lambda: ("GET", "/api/tnved?q=" + rng.choice(codes)[:rng.choice((4, 6, 10))], None)),
+        ("tnved_name", lambda: ("GET", "/api/tnved?q=" + q(rng.choice(WORDS)), None)),
+        ("tnved_tree", lambda: ("GET", "/api/tnved-tree?code=" + rng.choice(codes)[:rng.choice((2, 4, 6))], None)),
+        ("list", lambda: ("GET", "/api/list-gosts?cursor=" + q(rng.choice(gosts)), None)),
+        ("get_gost", lambda: ("GET", "/api/get-gost/" + q(rng.choice(gosts)), None)),
+        ("suggest", lambda: ("GET", "/api/suggest?q=" + q(rng.choice(WORDS)[:rng.randint(1, 5)]), None)),
+        ("crossref", lambda: ("GET", "/api/crossref?gost=" + q(rng.choice(gosts)), None)),
+        ("similar", lambda: ("GET", "/api/similar/" + q(rng.choice(gosts)), None)),
+        ("regulation_check", lambda: ("GET", f"/api/regulation-check?q={rng.choice(reg_codes)}&v=220", None)),
+        ("search_all", lambda: ("GET", "/api/search-all?v=220&q=" + q(rng.choice(
+            (rng.choice(WORDS), rng.choice(gosts).split()[-1], rng.choice(codes)[:rng.choice((4, 10))]))), None)),
+        ("regulation_batch", lambda: ("POST", "/api/regulation-check-batch",
+                                      [{"code": rng.choice(reg_codes + codes[:50]), "voltage": "220"} for _ in range(20)])),
+        ("duplicates", lambda: ("GET", "/api/duplicates", None)),
+        ("export_tnved", lambda: ("GET", "/api/export/tnved?q=" + rng.choice(codes)[:4], None)),
+        ("export_gost", lambda: ("GET", "/api/export/gost?format=csv&q=" + q(rng.choice(WORDS)), None)),
+        ("add_gost", add_gost),
+        ("update_gost", lambda: ("POST", "/api/update-gost", {
+            "number": rng.choice(gosts), "mark": sentence(rng, 4), "text": sentence(rng, 40)})),
+        ("delete_gost", delete_gost),
+        ("import_gosts", lambda: ("POST", "/api/import-gosts", Raw.ndjson(
+            {"gost": f"ГОСТ И{next(counter)}-{rng.randint(1990, 2024)}", "mark": sentence(rng, 4),
+             "text": sentence(rng, 40)} for _ in range(50)))),
+        ("upload_image", lambda: ("POST", "/api/upload-gost-image", Raw.multipart(
+            {"gost": rng.choice(gosts)}, {"image": ("bench.png", image)}))),
+        ("metrics", lambda: ("GET", "/metrics", None)),
+        ("cache_stats", lambda: ("GET", "/api/cache-stats", None)),
+    ]
+
+
+HEAVY = {"duplicates", "export_tnved", "export_gost", "regulation_batch", "import_gosts"}
+
+
+def q(s):
+    return urllib.parse.quote(s, safe="")
+
+
+def stats(latencies, wall):
+    xs = sorted(latencies)
+    pick = lambda p: round(1000 * xs[min(len(xs) - 1, int(p * len(xs)))], 3)
+    return {"n": len(xs), "p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "mean_ms": round(1000 * sum(xs) / len(xs), 3), "rps": round(len(xs) / wall, 1) if wall else None}
+
+
+def rss_kb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def rss_tree_kb(pid):
+    """RSS процесса и всех его потомков (мастер gunicorn + воркеры)."""
+    children = {}
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else ():
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        total += rss_kb(p) or 0
+        stack.extend(children.get(p, ()))
+    return total or None
+
+
+# ---------- тестовый клиент (в отдельном процессе) ----------
+
+def run_client(args):
+    os.chdir(args.data)
+    sys.path.insert(0, ROOT)
+    t0 = time.perf_counter()
+    import gost_search_app_v3 as app_module
+    t1 = time.perf_counter()
+    app_module.warm_up()
+    t2 = time.perf_counter()
+    result = {"import_s": round(t1 - t0, 3), "warm_up_s": round(t2 - t1, 3), "rss_after_warm_up_kb": rss_kb()}
+    meta = json.load(open("bench-meta.json", encoding="utf-8"))
+    rng = random.Random(SEED)
+    client = app_module.app.test_client()
+    endpoints = {}
+    for name, make in scenario(meta["gosts"], meta["codes"], rng):
+        n = min(args.requests, 5) if name in HEAVY else args.requests
+        latencies, start = [], time.perf_counter()
+        for _ in range(n):
+            method, url, body = make()
+            t = time.perf_counter()
+            data, content_type = encode(body)
+            resp = client.open(url, method=method, data=data, content_type=content_type)
+            resp.get_data()
+            latencies.append(time.perf_counter() - t)
+            if resp.status_code >= 500:
+                raise SystemExit(f"{name}: {url} -> {resp.status_code}")
+        endpoints[name] = stats(latencies, time.perf_counter() - start)
+    result["endpoints"] = endpoints
+    result["rss_end_kb"] = rss_kb()
+    print(json.dumps(result))
+
+
+# ---------- живой сервер ----------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, data, workers):
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), PYTHONPATH=ROOT, WEB_CONCURRENCY=str(workers))
+    if kind == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+               "--bind", f"127.0.0.1:{port}", "--chdir", data]
+    else:
+        cmd = [sys.executable, os.path.join(ROOT, "gost_search_app_v3.py"), "serve"]
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=data, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    while True:
+        if proc.poll() is not None:
+            raise SystemExit(f"{kind} не запустился (код {proc.returncode})")
+        try:
+            urllib.request.urlopen(base + "/", timeout=1).read()
+            break
+        except (urllib.error.URLError, ConnectionError, OSError):
+            time.sleep(0.05)
+    return proc, base, time.perf_counter() - t0
+
+
+def fetch(base, method, url, body):
+    data, content_type = encode(body)
+    req = urllib.request.Request(base + url, data=data, method=method,
+                                 headers={"Content-Type": content_type} if data is not None else {})
+    t = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            resp.read()
+    except urllib.error.HTTPError as e:
+        if e.code >= 500:
+            raise
+        e.read()
+    return time.perf_counter() - t
+
+
+def run_server(args, data, meta):
+    proc, base, startup = start_server(args.server, data, args.workers)
+    try:
+        result = {"server": args.server, "workers": args.workers, "concurrency": args.concurrency,
+                  "startup_s": round(startup, 3)}
+        rng = random.Random(SEED + 1)
+        lock = threading.Lock()
+        endpoints = {}
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for name, make in scenario(meta["gosts"], meta["codes"], rng):
+                n = min(args.requests, 5) if name in HEAVY else args.requests
+                with lock:      # генератор запросов не потокобезопасен — готовим заранее
+                    calls = [make() for _ in range(n)]
+                start = time.perf_counter()
+                latencies = list(pool.map(lambda c: fetch(base, *c), calls))
+                endpoints[name] = stats(latencies, time.perf_counter() - start)
+        result["endpoints"] = endpoints
+        result["rss_kb"] = rss_tree_kb(proc.pid)
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+# ---------- сравнение прогонов ----------
+
+def compare(old, new):
+    old_runs = {r["size"]: r for r in old["runs"]}
+    for run in new["runs"]:
+        base = old_runs.get(run["size"])
+        if not base:
+            continue
+        print(f"\n== {run['size']} записей (новое / старое)")
+        for mode in ("test_client", "live_server"):
+            if mode not in run or mode not in base:
+                continue
+            for name, s in run[mode]["endpoints"].items():
+                b = base[mode]["endpoints"].get(name)
+                if b:
+                    print(f"{mode:12} {name:18} p50 {s['p50_ms'] / max(b['p50_ms'], 1e-6):5.2f}x  "
+                          f"p95 {s['p95_ms'] / max(b['p95_ms'], 1e-6):5.2f}x  "
+                          f"p99 {s['p99_ms'] / max(b['p99_ms'], 1e-6):5.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1k,100k", help="размеры базы через запятую: 1k,100k,1m")
+    parser.add_argument("--requests", type=int, default=100, help="запросов на эндпоинт")
+    parser.add_argument("--concurrency", type=int, default=8, help="одновременных клиентов живого сервера")
+    parser.add_argument("--server", choices=("gunicorn", "waitress", "none"),
+                        default="gunicorn" if os.name == "posix" else "waitress")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--out", default="benchmark-results.json")
+    parser.add_argument("--compare", help="прошлый файл результатов")
+    parser.add_argument("--keep", action="store_true", help="не удалять сгенерированные базы")
+    parser.add_argument("--client", help=argparse.SUPPRESS)    # внутренний режим: прогон тестового клиента
+    parser.add_argument("--data", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.client:
+        return run_client(args)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    report = {"meta": {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "requests": args.requests, "concurrency": args.concurrency}, "runs": []}
+    for size in [parse_size(s) for s in args.sizes.split(",")]:
+        data = tempfile.mkdtemp(prefix=f"gost-bench-{size}-")
+        try:
+            t = time.perf_counter()
+            gosts, codes = generate(size, data)
+            run = {"size": size, "generate_s": round(time.perf_counter() - t, 3)}
+            meta = {"gosts": gosts, "codes": codes}
+            with open(os.path.join(data, "bench-meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            print(f"[{size}] база за {run['generate_s']} с", file=sys.stderr)
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), "--client", "1", "--data", data,
+                                  "--requests", str(args.requests)],
+                                 capture_output=True, text=True, check=True).stdout
+            run["test_client"] = json.loads(out.strip().splitlines()[-1])
+            print(f"[{size}] тестовый клиент готов", file=sys.stderr)
+            if args.server != "none":
+                run["live_server"] = run_server(args, data, meta)
+                print(f"[{size}] сервер ({args.server}) готов", file=sys.stderr)
+            report["runs"].append(run)
+        finally:
+            if not args.keep:
+                shutil.rmtree(data, ignore_errors=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"результаты: {args.out}", file=sys.stderr)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
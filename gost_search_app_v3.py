@@ -1,42 +1,2193 @@
-from flask import Flask, render_template_string, request, jsonify
-import json, os
+from flask import Flask, render_template_string, request, jsonify, Response, stream_with_context, make_response, g
+from flask import has_request_context, send_from_directory
+from werkzeug.exceptions import RequestEntityTooLarge
+from functools import wraps
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import gc, hashlib, json, os, re, sys, threading, bisect, csv, io, shutil, tempfile, sqlite3, html, zlib, mmap, struct
+import codecs, heapq, hmac, itertools, math, time, uuid, zipfile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from array import array
+
+try:
+    import fcntl
+except ImportError:     # Windows: только блокировки потоков внутри процесса
+    fcntl = None
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:     # без NumPy/SciPy «похожие» считаются тем же TF-IDF на словарях
+    np = sparse = None
 
 app = Flask(__name__)
+app.json.sort_keys = False   # порядок ключей = порядок ранжирования
+app.json.ensure_ascii = False   # кириллица как есть (UTF-8), а не \uXXXX — втрое меньше байт
+# тело больше — 413 ещё до чтения; импорт и пакетная проверка ограничены этим,
+# загрузка картинки — своим, меньшим пределом (см. upload_gost_image)
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("GOST_MAX_UPLOAD_MB", 256)) * 1024 * 1024
 
 DATA_FILE = "gost_data.json"
 TNVED_FILE = "tnved_data.json"
 REGULATION_FILE = "regulation.json"
+REGULATION_DIR = os.environ.get("GOST_REGULATIONS", "regulations")   # ещё регламенты, по файлу на каждый
+
+# json — файлы рядом с приложением; sqlite — одна база DB_FILE (WAL, FTS5)
+STORAGE = os.environ.get("GOST_STORAGE", "json")
+DB_FILE = os.environ.get("GOST_DB", "gost.db")
+
+
+COMPACT_RECORDS = 500       # столько записей в журнале — повод для сжатия
+COMPACT_INTERVAL = 30.0     # секунд; раз в столько сжимаем любой непустой журнал
+SNAPSHOTS = os.environ.get("GOST_SNAPSHOT", "1") != "0"   # двоичный снимок `<file>.snap` рядом с JSON
+
+# ---------- МЕТРИКИ ----------
+
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_HELP = {
+    "gost_requests_total": ("counter", "Запросы по эндпоинтам и кодам ответа"),
+    "gost_request_seconds": ("histogram", "Время обработки запроса до первого байта ответа"),
+    "gost_request_bytes_total": ("counter", "Байт в телах запросов"),
+    "gost_response_bytes_total": ("counter", "Байт в телах ответов (стриминг — по факту отдачи)"),
+    "gost_stage_seconds": ("histogram", "Время этапов: загрузка, запись, поиск, сериализация"),
+    "gost_records_scanned_total": ("counter", "Записей просмотрено поиском"),
+    "gost_records_returned_total": ("counter", "Записей отдано поиском"),
+    "gost_query_cache_hits_total": ("counter", "Попадания в кеш запросов"),
+    "gost_query_cache_misses_total": ("counter", "Промахи кеша запросов"),
+    "gost_query_cache_hit_ratio": ("gauge", "Доля попаданий в кеш запросов"),
+    "gost_query_cache_bytes": ("gauge", "Объём кеша запросов"),
+    "gost_records": ("gauge", "Записей в датасете"),
+    "gost_coalesced_total": ("counter", "Запросы, дождавшиеся чужого такого же вычисления"),
+    "gost_shed_total": ("counter", "Запросы, отклонённые с 503 из-за перегрузки"),
+    "gost_admission_wait_seconds": ("histogram", "Ожидание слота для тяжёлого вычисления"),
+    "gost_admission_waiting": ("gauge", "Запросов ждут слот сейчас"),
+    "gost_search_all_sources_total": ("counter", "Источники единого поиска по статусу ответа"),
+    "gost_image_jobs_total": ("counter", "Задачи обработки изображений по статусу"),
+}
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
+
+class Metrics:
+    """Счётчики и гистограммы процесса; /metrics отдаёт их в текстовом формате Prometheus.
+
+    Каждый воркер gunicorn считает своё (как и кеш запросов): Prometheus
+    суммирует по воркерам, если опрашивать их по отдельности.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}      # (имя, метки) -> значение
+        self.histograms = {}    # (имя, метки) -> [по корзинам..., +Inf, сумма, количество]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 3)
+            h[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+    def render(self, gauges=()):
+        """Текст для Prometheus; gauges — [(имя, метки, значение)] на момент опроса."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        families = {}       # имя -> [(метки, строки)]: строки одной серии в порядке выдачи
+        for (name, labels), value in counters.items():
+            families.setdefault(name, []).append((labels, [f"{name}{self._labels(labels)} {value}"]))
+        for name, labels, value in gauges:
+            labels = tuple(labels.items())
+            families.setdefault(name, []).append((labels, [f"{name}{self._labels(labels)} {value}"]))
+        for (name, labels), h in histograms.items():
+            lines = []
+            total = 0
+            # корзины — по возрастанию le, как требует формат; +Inf последней
+            for bound, count in zip(METRIC_BUCKETS + ("+Inf",), h):
+                total += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {total}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+            families.setdefault(name, []).append((labels, lines))
+        out = []
+        for name in sorted(families):
+            kind, text = METRIC_HELP.get(name, ("untyped", name))
+            out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for _, lines in sorted(families[name], key=lambda series: self._labels(series[0])):
+                out += lines
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+
+@contextmanager
+def timed(stage):
+    """Время этапа в gost_stage_seconds и в Server-Timing текущего запроса."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("gost_stage_seconds", elapsed, stage=stage)
+        timings = g.get("timings") if has_request_context() else None
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+# ---------- ДВОИЧНЫЙ СНИМОК ----------
+#
+# `<file>.snap` — тот же словарь, что в JSON, в компактном виде:
+#   заголовок: магия, (mtime_ns, size) исходного JSON, размеры секций;
+#   таблица строк: каждая различная строка один раз, смещения в символах;
+#   значения: каждое различное значение один раз, узлы — массив uint32
+#     (0 строка, 1 список, 2 словарь, 3 прочий JSON-литерал);
+#   записи: пары (ключ, номер значения) в порядке сортировки ключей.
+# При загрузке одинаковые строки и одинаковые значения становятся одним
+# объектом: в ТН ВЭД у многих кодов совпадают наименование, сектор и список
+# ГОСТов. Значения никто не меняет на месте (хранилища copy-on-write), так что
+# общие объекты безопасны. Если JSON изменился после снимка, читается JSON.
+
+SNAPSHOT_MAGIC = b"GOSTSNP1"
+SNAPSHOT_HEADER = struct.Struct("<8sqqIIII")
+S_STR, S_LIST, S_DICT, S_LIT = range(4)
+
+def write_snapshot(path, data, source):
+    """Пишет снимок словаря data, построенного из JSON с (mtime_ns, size) = source."""
+    strings, values, nodes, value_offsets = {}, {}, array("I"), array("I", [0])
+
+    def sid(s):
+        i = strings.get(s)
+        if i is None:
+            i = strings[s] = len(strings)
+        return i
+
+    def encode(v, out):
+        if isinstance(v, str):
+            out.extend((S_STR, sid(v)))
+        elif isinstance(v, list):
+            out.extend((S_LIST, len(v)))
+            for x in v:
+                encode(x, out)
+        elif isinstance(v, dict):
+            out.extend((S_DICT, len(v)))
+            for k, x in v.items():
+                out.append(sid(k))
+                encode(x, out)
+        else:
+            out.extend((S_LIT, sid(json.dumps(v))))
+
+    records = array("I")
+    for key in sorted(data):
+        out = array("I")
+        encode(data[key], out)
+        sig = out.tobytes()
+        vid = values.get(sig)
+        if vid is None:
+            vid = values[sig] = len(values)
+            nodes += out
+            value_offsets.append(len(nodes))
+        records.extend((sid(key), vid))
+
+    text = "".join(strings)
+    string_offsets = array("I", [0])
+    for st in strings:
+        string_offsets.append(string_offsets[-1] + len(st))
+    blob = text.encode("utf-8")
+    blob += b"\0" * (-len(blob) % 4)     # секции uint32 выровнены по 4 байта
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, source[0], source[1],
+                                     len(strings), len(values), len(records) // 2, len(blob)))
+        for section in (string_offsets, blob, value_offsets, nodes, records):
+            f.write(section if isinstance(section, bytes) else section.tobytes())
+    os.replace(tmp, path)
+
+def read_snapshot(path, source):
+    """Словарь из снимка через mmap или None, если снимка нет, он устарел или битый."""
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+    try:
+        if len(mm) < SNAPSHOT_HEADER.size:
+            return None
+        magic, mtime, size, n_str, n_val, n_rec, n_blob = SNAPSHOT_HEADER.unpack_from(mm)
+        if magic != SNAPSHOT_MAGIC or (mtime, size) != tuple(source):
+            return None
+        mv = memoryview(mm)
+        try:
+            pos = SNAPSHOT_HEADER.size
+
+            def take(count):
+                nonlocal pos
+                if pos + 4 * count > len(mv):
+                    raise ValueError("снимок обрезан")
+                section = mv[pos:pos + 4 * count].cast("I")
+                pos += 4 * count
+                return section
+
+            string_offsets = take(n_str + 1).tolist()
+            if pos + n_blob > len(mv):
+                raise ValueError("снимок обрезан")
+            text = str(mv[pos:pos + n_blob], "utf-8")
+            pos += n_blob
+            value_offsets = take(n_val + 1).tolist()
+            nodes = take(value_offsets[-1]).tolist()
+            records = take(2 * n_rec).tolist()
+        finally:
+            mv.release()
+    except (ValueError, struct.error, TypeError):
+        return None
+    finally:
+        mm.close()
+
+    strings = [text[string_offsets[i]:string_offsets[i + 1]] for i in range(n_str)]
+
+    def decode(i):
+        tag, arg = nodes[i], nodes[i + 1]
+        i += 2
+        if tag == S_STR:
+            return strings[arg], i
+        if tag == S_LIST:
+            out = []
+            for _ in range(arg):
+                v, i = decode(i)
+                out.append(v)
+            return out, i
+        if tag == S_DICT:
+            out = {}
+            for _ in range(arg):
+                k = strings[nodes[i]]
+                out[k], i = decode(i + 1)
+            return out, i
+        return json.loads(strings[arg]), i
+
+    values = [decode(value_offsets[v])[0] for v in range(n_val)]
+    return {strings[records[i]]: values[records[i + 1]] for i in range(0, len(records), 2)}
+
+
+class JsonStore:
+    """JSON-файл, загруженный в память один раз на процесс.
+
+    Файл перечитывается только когда меняются его mtime/size. Опубликованный
+    словарь никогда не меняется на месте: запись и перечитывание собирают
+    новый словарь и подменяют ссылку, поэтому читатель всегда видит целый снимок.
+
+    Изменения не переписывают весь файл, а дописываются одной строкой в журнал
+    `<file>.journal` (с fsync). Чтение = снимок + журнал поверх него; фоновый
+    поток периодически сворачивает журнал обратно в основной JSON-файл.
+
+    Между процессами (воркерами gunicorn) записи и сжатие упорядочены flock
+    на `<file>.lock`, перечитывание идёт под разделяемой блокировкой. Каждая
+    запись меняет размер журнала — это и есть «версия», по которой остальные
+    воркеры замечают изменение и докатывают хвост журнала.
+
+    Основной файл при наличии свежего `<file>.snap` читается из него (см.
+    «Двоичный снимок»); снимок пишется после каждой загрузки JSON и сжатия.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.lock_path = path + ".lock"
+        self.snapshot_path = path + ".snap"
+        self.lock = threading.RLock()
+        self.flock_depth = 0
+        self.data = {}
+        self.stamp = None
+        self.loaded = False
+        self.journal_offset = 0
+        self.journal_records = 0
+        self.version = 0            # растёт при каждом изменении данных в этом процессе
+        self.listeners = []
+        self.compact_event = threading.Event()
+        self.compactor = None
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _stamp(self):
+        return (self._stat(self.path), self._stat(self.journal_path))
+
+    @contextmanager
+    def _flock(self, shared=False):
+        """flock на `<file>.lock`; вызывать только под self.lock (вложенные вызовы — no-op).
+
+        Каталог только для чтения — файл блокировки не создать: остаётся одна
+        блокировка потоков, как без fcntl (писать там всё равно никто не может).
+        """
+        fd = None
+        if fcntl is not None and not self.flock_depth:
+            try:
+                fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError:
+                pass
+        if fd is None:
+            self.flock_depth += 1
             try:
-                return json.load(f)
-            except:
-                return {}
-    return {}
+                yield
+            finally:
+                self.flock_depth -= 1
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self.flock_depth += 1
+            yield
+        finally:
+            self.flock_depth -= 1
+            os.close(fd)
+
+    def after_fork(self):
+        """В дочернем процессе: свои блокировки и свой поток сжатия."""
+        self.lock = threading.RLock()
+        self.flock_depth = 0
+        self.compact_event = threading.Event()
+        self.compactor = None
+
+    def get(self):
+        if not self.loaded or self._stamp() != self.stamp:
+            with self.lock, self._flock(shared=True):
+                stamp = self._stamp()
+                if not self.loaded or stamp != self.stamp:
+                    self._reload(stamp)
+        return self.data
+
+    def _reload(self, stamp):
+        with timed("reload_" + os.path.splitext(os.path.basename(self.path))[0]):
+            self._reload_data(stamp)
+
+    def _reload_data(self, stamp):
+        base, journal = stamp
+        tail = self.loaded and base == self.stamp[0] and journal and self.stamp[1] \
+            and journal[1] >= self.journal_offset
+        if tail:
+            # снимок тот же, журнал только дописан (другим процессом) — докатываем хвост
+            data = dict(self.data)
+        else:
+            data = {}
+            if base is not None:
+                data = read_snapshot(self.snapshot_path, base) if SNAPSHOTS else None
+                if data is None:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        try:
+                            data = json.load(f)
+                        except:
+                            # битый файл: оставляем последний удачный снимок
+                            data = dict(self.data)
+                        else:
+                            self._save_snapshot(data, base)
+            self.journal_offset = 0
+            self.journal_records = 0
+        changes = self._replay(data)
+        self.data = data
+        self.stamp = stamp    # stat до чтения: дописанное позже подхватим следующим get()
+        self.loaded = True
+        if tail:
+            # индексы обновляются по записи, как при своей записи, а не пересобираются целиком
+            for change in changes:
+                self._notify(*change)
+        else:
+            self._notify(None, None, None)
+
+    def _replay(self, data):
+        """Накатывает журнал с journal_offset на data; возвращает [(key, old, new)]."""
+        changes = []
+        if not os.path.exists(self.journal_path):
+            return changes
+        with open(self.journal_path, "rb") as f:
+            f.seek(self.journal_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # запись ещё дописывается
+                self.journal_offset += len(line)
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                self.journal_records += 1
+                key = rec["key"]
+                if rec.get("op") == "del":
+                    if key in data:
+                        changes.append((key, data.pop(key), None))
+                else:
+                    changes.append((key, data.get(key), rec["value"]))
+                    data[key] = rec["value"]
+        return changes
+
+    def _save_snapshot(self, data, source):
+        """Снимок для следующего запуска; не вышло (только чтение, не словарь) — не беда."""
+        if not SNAPSHOTS or not isinstance(data, dict):
+            return
+        try:
+            write_snapshot(self.snapshot_path, data, source)
+        except OSError:
+            pass
+
+    def _notify(self, key, old, new):
+        self.version += 1
+        for fn in self.listeners:
+            fn(key, old, new)
+
+    def tag(self):
+        """Версия содержимого для ETag: одинакова во всех процессах, читающих
+        те же файлы, и меняется при каждой записи (растёт журнал или снимок)."""
+        parts = [n for st in self._stamp() if st for n in st]
+        return "-".join(f"{n:x}" for n in parts) or "0"
+
+    def _write(self, data):
+        # пишем во временный файл и атомарно подменяем, чтобы другой процесс
+        # никогда не прочитал наполовину записанный JSON
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp, self.path)
+
+    def _append(self, recs):
+        with timed("journal_append"):
+            self._append_lines(recs)
+
+    def _append_lines(self, recs):
+        lines = "".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in recs).encode("utf-8")
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, lines)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.journal_offset += len(lines)
+        self.journal_records += len(recs)
+
+    def save(self, data):
+        """Полная перезапись: новый снимок и пустой журнал."""
+        with self.lock, self._flock():
+            self._write(data)
+            self._save_snapshot(data, self._stat(self.path))
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.data = data
+            self.journal_offset = 0
+            self.journal_records = 0
+            self.stamp = self._stamp()
+            self.loaded = True
+            self._notify(None, None, None)
+
+    def put(self, key, value):
+        """Записывает одну запись (value=None — удаление) в журнал."""
+        return self.put_many([(key, value)])[0]
+
+    def put_many(self, items):
+        """Пачка записей: одна копия словаря, одна дозапись журнала и один fsync.
+
+        Возвращает список прежних значений в порядке items.
+        """
+        with self.lock, self._flock():
+            data = dict(self.get())     # сначала докатываем записи других воркеров
+            olds, changes, recs = [], [], []
+            for key, value in items:
+                old = data.get(key)
+                olds.append(old)
+                if value is None:
+                    if key not in data:
+                        continue
+                    del data[key]
+                    recs.append({"op": "del", "key": key})
+                else:
+                    data[key] = value
+                    recs.append({"op": "put", "key": key, "value": value})
+                changes.append((key, old, value))
+            if not recs:
+                return olds
+            self._append(recs)
+            self.data = data
+            self.stamp = self._stamp()
+            for change in changes:
+                self._notify(*change)
+            self._schedule_compaction()
+            return olds
+
+    def _schedule_compaction(self):
+        if self.compactor is None:
+            self.compactor = threading.Thread(target=self._compact_loop, daemon=True,
+                                              name=f"compact-{os.path.basename(self.path)}")
+            self.compactor.start()
+        if self.journal_records >= COMPACT_RECORDS:
+            self.compact_event.set()
+
+    def _compact_loop(self):
+        while True:
+            self.compact_event.wait(COMPACT_INTERVAL)
+            self.compact_event.clear()
+            try:
+                self.compact()
+            except OSError:
+                pass
+
+    def compact(self):
+        with timed("compact"):
+            self._compact()
+
+    def _compact(self):
+        """Сворачивает журнал в основной файл.
+
+        Сериализация идёт вне блокировки (снимок неизменяем); под блокировкой
+        только подмена файлов и перенос хвоста журнала, дописанного за это время.
+        """
+        with self.lock:
+            self.get()
+            if not self.journal_records:
+                return
+            data, offset, base = self.data, self.journal_offset, self.stamp[0]
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock, self._flock():
+            self.get()
+            if self.stamp[0] != base:
+                os.remove(tmp)      # другой воркер уже сжал журнал
+                return
+            with open(self.journal_path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            os.replace(tmp, self.path)
+            if tail:
+                jtmp = f"{self.journal_path}.{os.getpid()}.tmp"
+                with open(jtmp, "wb") as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(jtmp, self.journal_path)
+            else:
+                os.remove(self.journal_path)
+            self.journal_offset -= offset
+            self.journal_records = tail[:self.journal_offset].count(b"\n")
+            self.stamp = self._stamp()
+            base = self.stamp[0]
+        self._save_snapshot(data, base)
+
+
+class SqliteStore:
+    """Хранилище с тем же интерфейсом, что у JsonStore, поверх таблицы SQLite.
+
+    Таблица `<table>(key, value)` хранит запись как JSON; ключ — PRIMARY KEY,
+    поэтому поиск по коду и диапазону кодов идёт по индексу. Если задано
+    fts-выражение, триггеры поддерживают FTS5-таблицу `<table>_fts`.
+    Снимок в памяти перечитывается, когда счётчик таблицы в `meta` (его
+    поднимает каждая запись) расходится с прочитанным: PRAGMA data_version
+    для этого не годится — он меняется от коммита в любую таблицу базы.
+    """
+
+    def __init__(self, db_path, table, fts=None, tokenize="unicode61"):
+        self.path = db_path
+        self.table = table
+        self.fts = fts
+        self.lock = threading.RLock()
+        self.data = {}
+        self.table_version = None
+        self.version = 0
+        self.loaded = False
+        self.listeners = []
+        self._connect()
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (name, version) VALUES (?, 0)", (table,))
+        if fts:
+            self.conn.executescript(f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(body, tokenize='{tokenize}');
+CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON {table} BEGIN
+  INSERT INTO {table}_fts(rowid, body) VALUES (new.rowid, {fts.format(r="new")});
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON {table} BEGIN
+  DELETE FROM {table}_fts WHERE rowid = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE ON {table} BEGIN
+  DELETE FROM {table}_fts WHERE rowid = old.rowid;
+  INSERT INTO {table}_fts(rowid, body) VALUES (new.rowid, {fts.format(r="new")});
+END;
+""")
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    def after_fork(self):
+        """Соединение SQLite нельзя переносить через fork — открываем своё."""
+        self.lock = threading.RLock()
+        self._connect()
+
+    def get(self):
+        with self.lock:
+            version = self._table_version()
+            if not self.loaded or version != self.table_version:
+                rows = self.conn.execute(f"SELECT key, value FROM {self.table} ORDER BY rowid")
+                self.data = {k: json.loads(v) for k, v in rows}
+                self.table_version = version
+                self.loaded = True
+                self._notify(None, None, None)
+            return self.data
+
+    def _notify(self, key, old, new):
+        self.version += 1
+        for fn in self.listeners:
+            fn(key, old, new)
+
+    def tag(self):
+        """Счётчик записей из таблицы meta — общий для всех процессов."""
+        with self.lock:
+            return str(self._table_version())
+
+    def _table_version(self):
+        return self.conn.execute("SELECT version FROM meta WHERE name = ?", (self.table,)).fetchone()[0]
+
+    def _bump(self):
+        """Поднимает счётчик таблицы внутри текущей транзакции; свой коммит не перечитываем."""
+        self.conn.execute("UPDATE meta SET version = version + 1 WHERE name = ?", (self.table,))
+        self.table_version = self._table_version()
+
+    def save(self, data):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.execute(f"DELETE FROM {self.table}")
+                self.conn.executemany(
+                    f"INSERT INTO {self.table} (key, value) VALUES (?, ?)",
+                    ((k, json.dumps(v, ensure_ascii=False)) for k, v in data.items()))
+                self._bump()
+            self.data = data
+            self.loaded = True
+            self._notify(None, None, None)
+
+    def put(self, key, value):
+        """Записывает одну запись (value=None — удаление) одной транзакцией."""
+        return self.put_many([(key, value)])[0]
+
+    def put_many(self, items):
+        """Пачка записей одной транзакцией; возвращает прежние значения."""
+        with self.lock, timed("sqlite_write"):
+            olds, changes = [], []
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                data = dict(self.get())     # под блокировкой записи: чужой коммит уже виден
+                for key, value in items:
+                    old = data.get(key)
+                    olds.append(old)
+                    if value is None:
+                        if key not in data:
+                            continue
+                        del data[key]
+                        self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    else:
+                        data[key] = value
+                        self.conn.execute(
+                            f"INSERT INTO {self.table} (key, value) VALUES (?, ?) "
+                            f"ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                            (key, json.dumps(value, ensure_ascii=False)))
+                    changes.append((key, old, value))
+                if changes:
+                    self._bump()
+            self.data = data
+            for change in changes:
+                self._notify(*change)
+            return olds
+
+    def match(self, query):
+        """Ключи записей, чей FTS-текст соответствует выражению FTS5 query."""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT t.key FROM {self.table}_fts f JOIN {self.table} t ON t.rowid = f.rowid "
+                f"WHERE {self.table}_fts MATCH ?", (query,))
+            return {k for (k,) in rows}
+
+
+def fts_phrase(s):
+    return '"' + s.replace('"', '""') + '"'
+
+GOST_FTS = ("{r}.key || ' ' || coalesce(json_extract({r}.value, '$.mark'), '') || ' ' || "
+            "coalesce(json_extract({r}.value, '$.text'), '')")
+TNVED_FTS = "coalesce(json_extract({r}.value, '$.name'), '')"
+
+def make_stores(storage):
+    if storage == "sqlite":
+        return (SqliteStore(DB_FILE, "gost", GOST_FTS, tokenize="trigram"),
+                SqliteStore(DB_FILE, "tnved", TNVED_FTS),
+                SqliteStore(DB_FILE, "regulation"))
+    return JsonStore(DATA_FILE), JsonStore(TNVED_FILE), JsonStore(REGULATION_FILE)
+
+gost_store, tnved_store, regulation_store = make_stores(STORAGE)
 
-def save_data(data):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def load_data():
+    with timed("load_gost"):
+        return gost_store.get()
 
 def load_tnved():
-    if os.path.exists(TNVED_FILE):
-        with open(TNVED_FILE, "r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except:
-                return {}
-    return {}
-
-def load_regulation():
-    if os.path.exists(REGULATION_FILE):
-        with open(REGULATION_FILE, "r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except:
-                return {}
-    return {}
+    with timed("load_tnved"):
+        return tnved_store.get()
+
+WORD_RE = re.compile(r"\w+")
+
+GRAM = 3
+
+def ngrams(s, n=GRAM):
+    """Различные n-граммы строки; строка короче n граммов не даёт."""
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+class GostIndex:
+    """Инвертированный индекс по номеру, маркировке и тексту ГОСТов.
+
+    Поиск — подстрока, та же семантика, что у старого `q in combined`.
+    Индексируются слова текста: слово -> id записей и число вхождений;
+    слова словаря, содержащие часть запроса, находятся по их триграммам
+    (часть короче триграммы — просмотром словаря). Запрос из одного слова
+    считается целиком по спискам вхождений, не читая текстов; для фразы
+    списки сужают кандидатов, а вхождения считаются по тексту. Обновлённая
+    запись получает новый id, старый помечается удалённым; когда удалённых
+    становится много, индекс перестраивается.
+    """
+
+    use_grams = True
+    GARBAGE = 0.25      # доля удалённых id, после которой индекс перестраивается
+
+    def __init__(self):
+        self.docs = {}       # gost -> (gost_l, mark_l, text_l, combined)
+        self.ids = {}        # gost -> id
+        self.gosts = []      # id -> gost или None для удалённой записи
+        self.dead = set()    # id удалённых записей
+        self.words = {}      # слово -> (array id, array вхождений)
+        self.heads = {}      # слово номера или маркировки -> array id
+        self.lexicon = {}    # триграмма -> set(слово)
+        self.keys = []       # отсортированные номера — курсор для постраничного списка
+        self.dirty = True
+
+    def on_change(self, key, old, new):
+        if key is None:
+            self.dirty = True
+            return
+        if self.dirty:
+            return
+        self.remove(key)
+        if new is not None:
+            self.add(key, new)
+        if len(self.dead) > 1000 and len(self.dead) > self.GARBAGE * len(self.gosts):
+            self.dirty = True
+
+    def rebuild(self, data):
+        self.docs, self.ids, self.gosts, self.dead = {}, {}, [], set()
+        self.words, self.heads, self.lexicon = {}, {}, {}
+        for gost, info in data.items():
+            self.add(gost, info)
+        self.keys = sorted(self.docs)
+        self.dirty = False
+
+    def add(self, gost, info):
+        if isinstance(info, dict):
+            text = info.get("text", "")
+            mark = info.get("mark", "")
+        else:
+            text = str(info)
+            mark = ""
+        doc = (gost.lower(), mark.lower(), text.lower(), f"{gost} {mark} {text}".lower())
+        doc_id = len(self.gosts)
+        self.docs[gost] = doc
+        self.ids[gost] = doc_id
+        self.gosts.append(gost)
+        if not self.dirty:
+            bisect.insort(self.keys, gost)
+        words = self.words
+        for w, n in Counter(WORD_RE.findall(doc[3])).items():
+            posting = words.get(w)
+            if posting is None:
+                words[w] = (array("i", (doc_id,)), array("H", (min(n, 0xFFFF),)))
+                if self.use_grams:
+                    for gram in ngrams(w):
+                        self.lexicon.setdefault(gram, set()).add(w)
+            else:
+                posting[0].append(doc_id)
+                posting[1].append(min(n, 0xFFFF))
+        for w in set(WORD_RE.findall(f"{doc[0]} {doc[1]}")):
+            self.heads.setdefault(w, array("i")).append(doc_id)
+
+    def remove(self, gost):
+        """Запись пропадает из выдачи сразу; её id вычищаются перестройкой."""
+        if self.docs.pop(gost, None) is None:
+            return
+        doc_id = self.ids.pop(gost)
+        self.gosts[doc_id] = None
+        self.dead.add(doc_id)
+        i = bisect.bisect_left(self.keys, gost)
+        if i < len(self.keys) and self.keys[i] == gost:
+            del self.keys[i]
+
+    def vocabulary(self, t, left, right):
+        """Слова, где может стоять часть запроса t; left/right — граница слова
+        в запросе слева/справа от t, то есть слово начинается/кончается на t."""
+        if left and right:
+            return [t] if t in self.words else []
+        if len(t) >= GRAM:
+            pool = min((self.lexicon.get(gram, ()) for gram in ngrams(t)), key=len)
+        else:
+            pool = self.words
+        if left:
+            return [w for w in pool if w.startswith(t)]
+        if right:
+            return [w for w in pool if w.endswith(t)]
+        return [w for w in pool if t in w]
+
+    def candidates(self, q):
+        """id записей, которые могут содержать фразу q; проверяет их verify."""
+        parts = []
+        for m in WORD_RE.finditer(q):
+            words = self.vocabulary(m.group(), m.start() > 0, m.end() < len(q))
+            parts.append((sum(len(self.words[w][0]) for w in words), words))
+        if not parts:
+            return range(len(self.gosts))
+        parts.sort(key=lambda p: p[0])
+        result = None
+        for size, words in parts:
+            if result is not None and size > 8 * len(result):
+                break       # широкие части только удорожают пересечение — отсечёт проверка
+            ids = set()
+            for w in words:
+                ids.update(self.words[w][0])
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result
+
+    def verify(self, q, ids):
+        """{id: число вхождений q} по тексту записей-кандидатов."""
+        docs, gosts = self.docs, self.gosts
+        counts = {}
+        for i in ids:
+            gost = gosts[i]
+            if gost is not None:
+                n = docs[gost][3].count(q)
+                if n:
+                    counts[i] = n
+        return counts
+
+    def occurrences(self, q):
+        """{id: число вхождений q}, id записей с q в номере или маркировке
+        (None — не известны), число просмотренных записей."""
+        if not self.use_grams or not WORD_RE.fullmatch(q):
+            ids = self.candidates(q)
+            return self.verify(q, ids), None, len(ids)
+        # одно слово: каждое его вхождение лежит внутри слова текста
+        words = self.vocabulary(q, False, False)
+        if sum(len(self.words[w][0]) for w in words) > 10 * len(self.ids):
+            # короткий запрос внутри почти всех слов: текст прочитать дешевле
+            ids = range(len(self.gosts))
+            return self.verify(q, ids), None, len(ids)
+        counts, heads = {}, set()
+        for w in words:
+            ids, tfs = self.words[w]
+            k = w.count(q)
+            if not counts and k == 1:
+                counts = dict(zip(ids, tfs))
+            else:
+                get = counts.get
+                for i, n in zip(ids, tfs):
+                    counts[i] = get(i, 0) + n * k
+            heads.update(self.heads.get(w, ()))
+        for i in self.dead.intersection(counts):
+            del counts[i]
+        return counts, heads, len(counts)
+
+    def score(self, q, doc, count, whole_word):
+        gost_l, mark_l, _, _ = doc
+        score = 0
+        if gost_l == q:
+            score += 1000
+        elif gost_l.startswith(q):
+            score += 300
+        elif q in gost_l:
+            score += 200
+        if mark_l == q:
+            score += 150
+        elif q in mark_l:
+            score += 100
+        if whole_word:
+            score += 10
+        return score + (count if count < 20 else 20)
+
+    def page(self, cursor, limit):
+        """Следующие limit номеров после cursor в порядке сортировки."""
+        i = bisect.bisect_right(self.keys, cursor) if cursor else 0
+        return self.keys[i:i + limit], i + limit < len(self.keys)
+
+    def search(self, q, stats=None, top=None):
+        """[(gost, score)] по убыванию релевантности — все или лучшие top.
+
+        stats["scanned"] — число просмотренных записей, stats["matched"] — всего совпадений.
+        """
+        counts, heads, scanned = self.occurrences(q)
+        if stats is not None:
+            stats["scanned"] = scanned
+            stats["matched"] = len(counts)
+        whole = self.words.get(q)
+        whole = set(whole[0]) if whole else ()
+        docs, gosts, score = self.docs, self.gosts, self.score
+        # (-score, gost): порядок выдачи — обычное сравнение кортежей
+        if heads is not None:
+            # номер или маркировка дают от 100 очков, текст — не больше 30:
+            # если таких записей хватает на страницу, остальные не ранжируются
+            heads = heads.intersection(counts)
+            hits = [(-score(q, docs[gosts[i]], counts[i], i in whole), gosts[i]) for i in heads]
+            if top is None or len(hits) < top:
+                hits.extend((-(10 if i in whole else 0) - (n if n < 20 else 20), gosts[i])
+                            for i, n in counts.items() if i not in heads)
+        else:
+            hits = [(-score(q, docs[gosts[i]], n, i in whole), gosts[i]) for i, n in counts.items()]
+        if top is not None and top < len(hits):
+            hits = heapq.nsmallest(top, hits)
+        else:
+            hits.sort()
+        return [(gost, -neg) for neg, gost in hits]
+
+
+class SqliteGostIndex(GostIndex):
+    """Кандидатов даёт FTS5 (trigram) из SqliteStore вместо триграмм словаря в памяти."""
+
+    use_grams = False
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def candidates(self, q):
+        if len(q) < GRAM:
+            return range(len(self.gosts))   # trigram не ищет короче 3 символов
+        ids = self.ids
+        return [ids[gost] for gost in self.store.match(fts_phrase(q)) if gost in ids]
+
+
+gost_index = SqliteGostIndex(gost_store) if STORAGE == "sqlite" else GostIndex()
+gost_store.listeners.append(gost_index.on_change)
+
+# ---------- НЕЧЁТКИЙ ПОИСК ПО НОМЕРУ ГОСТа ----------
+
+CONFUSABLES = str.maketrans("abcehkmoptxy", "авсенкмортху")   # латиница, похожая на кириллицу
+GOST_WORDS = {"gost": "гост", "r": "р", "мэк": "iec", "исо": "iso"}
+YEAR_PIVOT = 30     # «-04» -> 2004, «-84» -> 1984
+
+def gost_key(s):
+    """Канонический ключ номера: «GOST 3940-04», «гост 3940 2004» -> «3940 2004»."""
+    out = []
+    for t in re.findall(r"[^\W\d_]+|\d+", s.lower().replace("ё", "е")):
+        t = GOST_WORDS.get(t, t).translate(CONFUSABLES)
+        if t == "гост":
+            continue
+        if out and not t.isdigit() and not out[-1].isdigit():
+            out[-1] += t        # «O`z DSt» и «OzDSt» дают одно слово
+        else:
+            out.append(t)
+    if len(out) >= 2 and out[-1].isdigit() and out[-2].isdigit() and len(out[-1]) == 2:
+        out[-1] = ("20" if int(out[-1]) < YEAR_PIVOT else "19") + out[-1]
+    return " ".join(out)
+
+def gost_keys(number):
+    """Ключи записи: по каждому номеру из «ГОСТ А, ГОСТ Б» — с годом и без года."""
+    keys = set()
+    for part in number.split(","):
+        key = gost_key(part)
+        if not key:
+            continue
+        keys.add(key)
+        head, _, year = key.rpartition(" ")
+        if head and len(year) == 4 and year[:2] in ("19", "20") and head.split()[-1].isdigit():
+            keys.add(head)
+    return keys
+
+NUMBER_TYPOS = 2    # больше правок в номере нечёткий поиск не ищет
+
+
+def next_row(row, ch, q, center, max_dist):
+    """Строка таблицы Левенштейна для префикса, удлинённого символом ch,
+    и нижняя граница расстояния до ключа целиком.
+
+    Считается полоса клеток |j - center| <= max_dist у диагонали: дальше от
+    неё на разницу длин остатков уйдёт больше max_dist правок.
+    """
+    far = max_dist + 1
+    cur = [far] * len(row)
+    lo, hi = max(center - max_dist, 0), min(center + max_dist, len(q))
+    best = far
+    if lo == 0:
+        cur[0] = d = row[0] + 1
+        best = d + center
+        lo = 1
+    for j in range(lo, hi + 1):
+        d = row[j - 1] + (q[j - 1] != ch)
+        if row[j] < d:
+            d = row[j] + 1
+        if cur[j - 1] < d:
+            d = cur[j - 1] + 1
+        cur[j] = d
+        d += j - center if j > center else center - j
+        if d < best:
+            best = d
+    return cur, best
+
+
+def prefix_end(prefix):
+    """Наименьшая строка больше всех строк, начинающихся с prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class GostNumberIndex:
+    """Канонические ключи номеров (считаются при загрузке), разложенные по длине.
+
+    Отсортированный список ключей одной длины — неявное префиксное дерево:
+    соседние ключи делят строки таблицы Левенштейна общего префикса, а
+    префикс, который уже дальше допустимого расстояния, пропускается вместе
+    со всеми ключами на него (bisect). Длина ключей известна, поэтому
+    считается только полоса клеток у диагонали. Удалённые записи просто
+    исчезают из keys; их ключи остаются в списках до полной пересборки.
+    """
+
+    def __init__(self):
+        self.keys = {}      # ключ -> set(gost)
+        self.by_gost = {}   # gost -> set(ключ)
+        self.lengths = {}   # длина -> отсортированные ключи этой длины
+        self.dirty = True
+
+    def on_change(self, key, old, new):
+        if key is None:
+            self.dirty = True
+        elif not self.dirty:
+            self.remove(key)
+            if new is not None:
+                self.add(key)
+
+    def rebuild(self, data):
+        self.keys, self.by_gost, self.lengths = {}, {}, {}
+        for gost in data:
+            self.add(gost, insort=False)
+        for keys in self.lengths.values():
+            keys.sort()
+        self.dirty = False
+
+    def add(self, gost, insort=True):
+        keys = gost_keys(gost)
+        self.by_gost[gost] = keys
+        for key in keys:
+            if key not in self.keys:
+                self.keys[key] = set()
+                same = self.lengths.setdefault(len(key), [])
+                if insort:
+                    bisect.insort(same, key)
+                else:
+                    same.append(key)
+            self.keys[key].add(gost)
+
+    def remove(self, gost):
+        for key in self.by_gost.pop(gost, ()):
+            self.keys.get(key, set()).discard(gost)
+
+    def similar(self, q, max_dist):
+        """[(ключ, расстояние)] для ключей на расстоянии Левенштейна не больше max_dist."""
+        found = []
+        for length in range(max(len(q) - max_dist, 1), len(q) + max_dist + 1):
+            found += self._similar(q, max_dist, self.lengths.get(length, ()), len(q) - length)
+        return found
+
+    @staticmethod
+    def _similar(q, max_dist, keys, shift):
+        """Ключи одной длины; shift — на сколько q длиннее их."""
+        rows = [list(range(len(q) + 1))]    # rows[d] — строка для prev[:d]
+        prev = ""
+        found = []
+        i = 0
+        while i < len(keys):
+            word = keys[i]
+            common = 0
+            limit = min(len(prev), len(rows) - 1)
+            while common < limit and word[common] == prev[common]:
+                common += 1
+            del rows[common + 1:]
+            for depth in range(common, len(word)):
+                row, best = next_row(rows[depth], word[depth], q, depth + 1 + shift, max_dist)
+                rows.append(row)
+                if best > max_dist:
+                    prev = word[:depth + 1]
+                    i = bisect.bisect_left(keys, prefix_end(prev), i + 1)
+                    break
+            else:
+                if rows[-1][-1] <= max_dist:
+                    found.append((word, rows[-1][-1]))
+                prev = word
+                i += 1
+        return found
+
+    def match(self, q, typos=True):
+        """{gost: расстояние} для номеров, совпадающих с q с точностью до 1–2 правок.
+
+        Если такой номер есть точно или typos ложно, опечатки не ищутся.
+        """
+        key = gost_key(q)
+        if not any(ch.isdigit() for ch in key):
+            return {}
+        exact = self.keys.get(key)
+        if exact or not typos:
+            return dict.fromkeys(exact or (), 0)
+        found = {}
+        for word, d in self.similar(key, 1 if len(key) <= 6 else NUMBER_TYPOS):
+            for gost in self.keys.get(word, ()):
+                if d < found.get(gost, d + 1):
+                    found[gost] = d
+        return found
+
+
+gost_numbers = GostNumberIndex()
+gost_store.listeners.append(gost_numbers.on_change)
+
+# ---------- ПОЧТИ-ДУБЛИКАТЫ ТЕКСТОВ (MinHash + LSH) ----------
+
+DUP_PERMUTATIONS = 64      # длина сигнатуры
+DUP_BANDS = 8               # 8 полос по 8 значений: пара с Жаккаром ~0.8 попадает в общую корзину почти всегда
+DUP_THRESHOLD = 0.8         # оценка сходства по сигнатурам, с которой тексты считаются дублями
+DUP_MIN_WORDS = 5           # короче — не сравниваем: «.» и «см. п. 1» не дубликаты
+
+def minhash(text):
+    """MinHash-сигнатура по словным триграммам текста или None для слишком коротких.
+
+    Одна хеш-функция вместо DUP_PERMUTATIONS (one permutation hashing):
+    хеш шингла выбирает ячейку и даёт значение, в ячейке — минимум. Пустые
+    ячейки берут значение ближайшей непустой справа со сдвигом на расстояние
+    (densification), так что сигнатуры сравнимы поэлементно, как обычные.
+    """
+    words = WORD_RE.findall(text.lower())
+    if len(words) < DUP_MIN_WORDS:
+        return None
+    bins = [None] * DUP_PERMUTATIONS
+    for i in range(len(words) - 2):
+        h = int.from_bytes(hashlib.blake2b(" ".join(words[i:i + 3]).encode("utf-8"),
+                                           digest_size=8).digest(), "little")
+        cell, value = h % DUP_PERMUTATIONS, h // DUP_PERMUTATIONS
+        if bins[cell] is None or value < bins[cell]:
+            bins[cell] = value
+    filled = [i for i, v in enumerate(bins) if v is not None]
+    sig = []
+    for i, v in enumerate(bins):
+        if v is None:
+            j = filled[bisect.bisect_right(filled, i) % len(filled)]
+            v = bins[j] + (((j - i) % DUP_PERMUTATIONS) << 58)     # значения ячеек < 2**58
+        sig.append(v)
+    return tuple(sig)
+
+def signature_similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / DUP_PERMUTATIONS
+
+
+class DuplicateIndex:
+    """LSH-корзины MinHash-сигнатур текстов ГОСТов.
+
+    Кандидаты в дубли — записи с общей корзиной хотя бы в одной полосе:
+    поиск для нового текста стоит O(полос), а не O(n), кластеры строятся
+    объединением корзин без попарного сравнения всего корпуса.
+    """
+
+    def __init__(self):
+        self.signatures = {}    # gost -> сигнатура
+        self.buckets = {}       # (полоса, значения полосы) -> set(gost)
+        self.dirty = True
+
+    def on_change(self, key, old, new):
+        if key is None:
+            self.dirty = True
+        elif not self.dirty:
+            self.remove(key)
+            if new is not None:
+                self.add(key, new)
+
+    def rebuild(self, data):
+        self.signatures, self.buckets = {}, {}
+        for gost, info in data.items():
+            self.add(gost, info)
+        self.dirty = False
+
+    @staticmethod
+    def _bands(sig):
+        rows = DUP_PERMUTATIONS // DUP_BANDS
+        return [(i, sig[i * rows:(i + 1) * rows]) for i in range(DUP_BANDS)]
+
+    def add(self, gost, info):
+        sig = minhash(info.get("text", "") if isinstance(info, dict) else str(info))
+        if sig is None:
+            return
+        self.signatures[gost] = sig
+        for band in self._bands(sig):
+            self.buckets.setdefault(band, set()).add(gost)
+
+    def remove(self, gost):
+        sig = self.signatures.pop(gost, None)
+        if sig is None:
+            return
+        for band in self._bands(sig):
+            ids = self.buckets.get(band)
+            if ids is not None:
+                ids.discard(gost)
+                if not ids:
+                    del self.buckets[band]
+
+    def near(self, text, exclude=None):
+        """[(gost, сходство)] для записей, почти совпадающих с text по тексту."""
+        sig = minhash(text)
+        if sig is None:
+            return []
+        candidates = set()
+        for band in self._bands(sig):
+            candidates |= self.buckets.get(band, set())
+        candidates.discard(exclude)
+        found = [(g, signature_similarity(sig, self.signatures[g])) for g in candidates]
+        return sorted(((g, round(sim, 3)) for g, sim in found if sim >= DUP_THRESHOLD),
+                      key=lambda h: (-h[1], h[0]))
+
+    def clusters(self):
+        """Группы почти-дубликатов: объединение (union-find) внутри корзин.
+
+        Каждый член корзины сверяется только с её первым элементом, так что
+        работа линейна по суммарному размеру корзин.
+        """
+        parent = {}
+
+        def find(gost):
+            while parent.get(gost, gost) != gost:
+                parent[gost] = parent.get(parent[gost], parent[gost])
+                gost = parent[gost]
+            return gost
+
+        for ids in self.buckets.values():
+            if len(ids) < 2:
+                continue
+            members = sorted(ids)
+            head, sig = members[0], self.signatures[members[0]]
+            for gost in members[1:]:
+                if signature_similarity(sig, self.signatures[gost]) >= DUP_THRESHOLD:
+                    a, b = find(head), find(gost)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+        groups = {}
+        for gost in parent:
+            groups.setdefault(find(gost), []).append(gost)
+        return sorted((sorted(set(m) | {root}) for root, m in groups.items()),
+                      key=lambda m: (-len(m), m[0]))
+
+
+gost_dups = DuplicateIndex()
+gost_store.listeners.append(gost_dups.on_change)
+
+def gost_snapshot():
+    """Текущий словарь ГОСТов; индексы гарантированно соответствуют ему."""
+    with gost_store.lock:
+        data = load_data()
+        if gost_index.dirty:
+            gost_index.rebuild(data)
+        if gost_numbers.dirty:
+            gost_numbers.rebuild(data)
+        if gost_dups.dirty:
+            gost_dups.rebuild(data)
+        return data
+
+TNVED_LEVELS = (2, 4, 6, 8, 10)   # группа -> товарная позиция -> субпозиция -> ...
+
+
+class TnvedIndex:
+    """Отсортированный массив кодов ТН ВЭД (bisect) и индекс слов наименований."""
+
+    def __init__(self):
+        self.codes = []
+        self.words = {}      # слово -> set(code)
+        self.vocab = []      # отсортированные слова для поиска по началу слова
+        self.dirty = True
+
+    def on_change(self, key, old, new):
+        self.dirty = True
+
+    def rebuild(self, data):
+        self.codes = sorted(data)
+        self.words = {}
+        for code, info in data.items():
+            for w in set(WORD_RE.findall(info.get("name", "").lower())):
+                self.words.setdefault(w, set()).add(code)
+        self.vocab = sorted(self.words)
+        self.dirty = False
+
+    def _range(self, prefix):
+        lo = bisect.bisect_left(self.codes, prefix)
+        hi = bisect.bisect_left(self.codes, prefix + "\uffff", lo)
+        return lo, hi
+
+    def count(self, prefix):
+        lo, hi = self._range(prefix)
+        return hi - lo
+
+    def prefix(self, prefix, limit):
+        """Коды, начинающиеся с prefix, по порядку: (total, [code]) за O(log n + k)."""
+        lo, hi = self._range(prefix)
+        return hi - lo, self.codes[lo:min(hi, lo + limit)]
+
+    def children(self, prefix):
+        """Ближайший уровень иерархии под prefix: [(code, count)]."""
+        level = next((n for n in TNVED_LEVELS if n > len(prefix)), None)
+        if level is None:
+            return []
+        result = []
+        lo, hi = self._range(prefix)
+        while lo < hi:
+            child = self.codes[lo][:level]
+            end = bisect.bisect_left(self.codes, child + "\uffff", lo, hi)
+            result.append((child, end - lo))
+            lo = end
+        return result
+
+    def name_search(self, q, limit):
+        """Все слова запроса — как начала слов наименования. Результат по порядку кодов."""
+        result = None
+        for token in WORD_RE.findall(q):
+            found = set()
+            i = bisect.bisect_left(self.vocab, token)
+            while i < len(self.vocab) and self.vocab[i].startswith(token):
+                found |= self.words[self.vocab[i]]
+                i += 1
+            result = found if result is None else result & found
+            if not result:
+                return 0, []
+        if not result:
+            return 0, []
+        return len(result), sorted(result)[:limit]
+
+
+class SqliteTnvedIndex(TnvedIndex):
+    """Поиск по наименованию через FTS5 (префиксные запросы слов)."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def rebuild(self, data):
+        self.codes = sorted(data)
+        self.dirty = False
+
+    def name_search(self, q, limit):
+        tokens = WORD_RE.findall(q)
+        if not tokens:
+            return 0, []
+        result = self.store.match(" AND ".join(fts_phrase(t) + "*" for t in tokens))
+        return len(result), sorted(result)[:limit]
+
+
+tnved_index = SqliteTnvedIndex(tnved_store) if STORAGE == "sqlite" else TnvedIndex()
+tnved_store.listeners.append(tnved_index.on_change)
+
+# ---------- ПЕРЕКРЁСТНЫЕ ССЫЛКИ ГОСТ <-> ТН ВЭД ----------
+
+CROSSREF_LINKS = 50
+
+
+class CrossRef:
+    """Стандарт -> коды ТН ВЭД (из списков standards) и код -> стандарты.
+
+    Стандарты сводятся к тем же каноническим ключам gost_key(), что и номера
+    ГОСТов, поэтому «ГОСТ 18599-2001» из ТН ВЭД находит запись gost_data.json
+    через gost_numbers. Сторона ГОСТов целиком живёт в gost_numbers и
+    обновляется по одной записи; здесь пересобирается только сторона ТН ВЭД.
+    """
+
+    def __init__(self):
+        self.codes = {}     # ключ стандарта -> set(code)
+        self.standards = {} # code -> [(стандарт, ключ)]
+        self.dirty = True
+
+    def on_change(self, key, old, new):
+        self.dirty = True
+
+    def rebuild(self, data):
+        self.codes, self.standards = {}, {}
+        for code, info in data.items():
+            refs = []
+            for std in info.get("standards", []):
+                key = gost_key(std)
+                if key:
+                    refs.append((std, key))
+                    self.codes.setdefault(key, set()).add(code)
+            self.standards[code] = refs
+        self.dirty = False
+
+    def codes_for(self, number):
+        """Коды ТН ВЭД, ссылающиеся на номер (есть он в базе или нет)."""
+        keys = gost_numbers.by_gost.get(number) or gost_keys(number)
+        codes = set()
+        for key in keys:
+            codes |= self.codes.get(key, set())
+        return sorted(codes)
+
+    def gosts_for(self, code):
+        """Записи gost_data.json, на которые ссылается код."""
+        found = set()
+        for _, key in self.standards.get(code, ()):
+            found |= gost_numbers.keys.get(key, set())
+        return sorted(found)
+
+    def standards_for(self, code):
+        return [{"standard": std, "gosts": sorted(gost_numbers.keys.get(key, ()))}
+                for std, key in self.standards.get(code, ())]
+
+
+crossref = CrossRef()
+tnved_store.listeners.append(crossref.on_change)
+
+def tnved_snapshot():
+    with tnved_store.lock:
+        data = load_tnved()
+        if tnved_index.dirty:
+            tnved_index.rebuild(data)
+        if crossref.dirty:
+            crossref.rebuild(data)
+        return data
+
+TNVED_LIMIT = 100
+TNVED_MAX_LIMIT = 1000
+
+def tnved_code(q):
+    """«8418 10 200 1» / «8418.10» -> «841810…», если запрос состоит только из цифр."""
+    code = re.sub(r"[\s.\-]", "", q)
+    return code if code.isdigit() else None
+
+# ---------- ПОХОЖИЕ СТАНДАРТЫ (TF-IDF) ----------
+
+SIMILAR_TOP = 10
+SIMILAR_MAX_TOP = 50
+SIMILAR_STEM = 6        # слово усекается до основы такой длины: «маркировка» ~ «маркировки»
+
+def similar_terms(text):
+    """{терм: вес tf} — сублинейный tf по словам от 3 букв (без чисел)."""
+    counts = {}
+    for w in WORD_RE.findall(text.lower()):
+        if len(w) >= 3 and not w.isdigit():
+            t = w[:SIMILAR_STEM]
+            counts[t] = counts.get(t, 0) + 1
+    return {t: 1.0 + math.log(n) for t, n in counts.items()}
+
+
+class SimilarIndex:
+    """TF-IDF по маркировке и тексту ГОСТов и наименованиям ТН ВЭД; косинусная близость.
+
+    Документы — ("g", номер) и ("t", код). Слушатели хранилищ пересчитывают
+    термы только изменённой записи и df. С NumPy/SciPy строки складываются в
+    разреженную CSR-матрицу (idf и нормировка — векторно), матрица собирается
+    лениво после изменений, а оценки для пачки запросов — одно умножение
+    M @ Q.T. Без них — тот же TF-IDF по инвертированному индексу на словарях.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.terms = {}          # терм -> номер столбца (не переиспользуется)
+        self.df = []             # номер столбца -> число документов с термом
+        self.rows = {}           # документ -> (столбцы, веса tf)
+        self.postings = {}       # без NumPy: столбец -> {документ: вес tf}
+        self.stale = {"g": True, "t": True}   # датасет перечитан целиком — загрузить заново
+        self.matrix = None       # собранная нормированная матрица и порядок документов
+        self.norms = None        # без NumPy: нормы документов при текущих idf
+
+    def on_change(self, kind, key, old, new):
+        with self.lock:
+            if key is None:
+                self.stale[kind] = True
+            elif not self.stale[kind]:
+                self._set((kind, key), self._text(kind, new) if new is not None else None)
+
+    @staticmethod
+    def _text(kind, info):
+        if kind == "t":
+            return info.get("name", "") if isinstance(info, dict) else str(info)
+        if isinstance(info, dict):
+            return f"{info.get('mark', '')} {info.get('text', '')}"
+        return str(info)
+
+    def _set(self, doc, text):
+        row = self.rows.pop(doc, None)
+        if row is not None:
+            for col in row[0]:
+                self.df[col] -= 1
+                if np is None:
+                    del self.postings[col][doc]
+        if text is not None:
+            cols, weights = [], []
+            for term, w in similar_terms(text).items():
+                col = self.terms.get(term)
+                if col is None:
+                    col = self.terms[term] = len(self.df)
+                    self.df.append(0)
+                self.df[col] += 1
+                if np is None:
+                    self.postings.setdefault(col, {})[doc] = w
+                cols.append(col)
+                weights.append(w)
+            if cols:
+                self.rows[doc] = (tuple(cols), tuple(weights))
+        self.matrix = self.norms = None
+
+    def _load(self, kind, data):
+        for doc in [d for d in self.rows if d[0] == kind]:
+            self._set(doc, None)
+        for key, info in data.items():
+            self._set((kind, key), self._text(kind, info))
+        self.stale[kind] = False
+
+    def _idf(self):
+        n = len(self.rows) + 1
+        if np is not None:
+            return np.log(n / (np.asarray(self.df, dtype=np.float64) + 1.0)) + 1.0
+        return [math.log(n / (df + 1.0)) + 1.0 for df in self.df]
+
+    def _assemble(self):
+        """CSR-матрица документов (строки нормированы) — из готовых строк, без токенизации."""
+        order = list(self.rows)
+        lengths = np.fromiter((len(self.rows[d][0]) for d in order), dtype=np.int64, count=len(order))
+        indptr = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        cols = np.fromiter(itertools.chain.from_iterable(self.rows[d][0] for d in order),
+                           dtype=np.int32, count=int(indptr[-1]))
+        weights = np.fromiter(itertools.chain.from_iterable(self.rows[d][1] for d in order),
+                              dtype=np.float64, count=int(indptr[-1]))
+        weights *= self._idf()[cols]
+        m = sparse.csr_matrix((weights, cols, indptr), shape=(len(order), len(self.df)))
+        norms = np.sqrt(np.asarray(m.multiply(m).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        self.matrix = (sparse.diags(1.0 / norms) @ m).tocsr(), order, {d: i for i, d in enumerate(order)}
+
+    def prepare(self, gosts, tnved):
+        """Догружает перечитанные датасеты; вызывать со снимками обоих хранилищ."""
+        with self.lock:
+            for kind, data in (("g", gosts), ("t", tnved)):
+                if self.stale[kind]:
+                    self._load(kind, data)
+
+    def similar(self, docs, k, kinds="gt"):
+        """Для каждого документа из docs — [(doc, score)] топ-k соседей (сам документ исключён)."""
+        with self.lock:
+            if np is not None:
+                return self._similar_sparse(docs, k, kinds)
+            return self._similar_dicts(docs, k, kinds)
+
+    def _similar_sparse(self, docs, k, kinds):
+        if self.matrix is None:
+            self._assemble()
+        m, order, pos = self.matrix
+        rows = [pos[d] for d in docs if d in pos]
+        if not rows:
+            return [[] for _ in docs]
+        scores = (m @ m[rows].T).toarray()      # (документы × запросы) — одно умножение на пачку
+        allowed = np.fromiter((d[0] in kinds for d in order), dtype=bool, count=len(order))
+        scores[~allowed] = 0.0
+        results, j = [], 0
+        for d in docs:
+            if d not in pos:
+                results.append([])
+                continue
+            col = scores[:, j]
+            col[pos[d]] = 0.0
+            j += 1
+            top = np.argpartition(-col, min(k, len(col) - 1))[:k]
+            top = sorted(top, key=lambda i: (-col[i], order[i]))
+            results.append([(order[i], round(float(col[i]), 4)) for i in top if col[i] > 0])
+        return results
+
+    def _similar_dicts(self, docs, k, kinds):
+        idf = self._idf()
+        if self.norms is None:
+            self.norms = {d: math.sqrt(sum((w * idf[c]) ** 2 for c, w in zip(*row))) or 1.0
+                          for d, row in self.rows.items()}
+        results = []
+        for d in docs:
+            row = self.rows.get(d)
+            if row is None:
+                results.append([])
+                continue
+            acc = {}
+            for col, w in zip(*row):
+                qw = w * idf[col] * idf[col]
+                for other, ow in self.postings[col].items():
+                    acc[other] = acc.get(other, 0.0) + qw * ow
+            acc.pop(d, None)
+            qn = self.norms[d]
+            top = sorted(((o, s / (qn * self.norms[o])) for o, s in acc.items() if o[0] in kinds),
+                         key=lambda h: (-h[1], h[0]))[:k]
+            results.append([(o, round(s, 4)) for o, s in top])
+        return results
+
+
+similar_index = SimilarIndex()
+gost_store.listeners.append(lambda *change: similar_index.on_change("g", *change))
+tnved_store.listeners.append(lambda *change: similar_index.on_change("t", *change))
+
+def similar_to(gosts, k, kinds="gt"):
+    """Соседи для списка номеров ГОСТов: [[(doc, score)]]."""
+    similar_index.prepare(gost_snapshot(), tnved_snapshot())
+    with timed("similar"):
+        found = similar_index.similar([("g", g) for g in gosts], k, kinds)
+    metrics.inc("gost_records_scanned_total", len(similar_index.rows) * len(gosts), search="similar")
+    metrics.inc("gost_records_returned_total", sum(map(len, found)), search="similar")
+    return found
+
+# ---------- ТЕХРЕГЛАМЕНТЫ ----------
+
+class RegulationSet:
+    """regulation.json плюс все *.json из REGULATION_DIR (каждый файл — один регламент).
+
+    Для каждого файла свой JsonStore; каталог пересматривается, когда меняется
+    его mtime. tag() объединяет версии всех файлов — для ETag.
+    """
+
+    def __init__(self, base, directory):
+        self.base = base
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.stores = {}
+        self.dir_stamp = None
+
+    def _scan(self):
+        try:
+            stamp = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            stamp = None
+        if stamp == self.dir_stamp:
+            return
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".json")) if stamp else []
+        self.stores = {n: self.stores.get(n) or JsonStore(os.path.join(self.directory, n)) for n in names}
+        self.dir_stamp = stamp
+
+    def get(self):
+        with self.lock:
+            self._scan()
+            regs = [self.base.get()] + [store.get() for store in self.stores.values()]
+            return [reg for reg in regs if isinstance(reg, dict) and reg]
+
+    def tag(self):
+        with self.lock:
+            self._scan()
+            return ".".join([self.base.tag()] + [s.tag() for s in self.stores.values()])
+
+    def after_fork(self):
+        self.lock = threading.RLock()
+        for store in self.stores.values():
+            store.after_fork()
+
+
+def digits(s):
+    return re.sub(r"\D", "", str(s))
+
+
+class VoltageIndex:
+    """Интервальный индекс: напряжение -> множество регламентов, чей диапазон его содержит.
+
+    Границы всех диапазонов делят ось на точки и промежутки между ними; для
+    каждой точки и каждого промежутка множество посчитано при компиляции,
+    поэтому запрос — один bisect.
+    """
+
+    def __init__(self, ranges, everyone):
+        # ranges: [(i, lo, hi)]; регламенты без диапазона подходят при любом напряжении
+        self.unbounded = frozenset(everyone - {i for i, _, _ in ranges})
+        self.points = sorted({v for _, lo, hi in ranges for v in (lo, hi)})
+        self.at = [self.unbounded | {i for i, lo, hi in ranges if lo <= p <= hi} for p in self.points]
+        bounds = [float("-inf")] + self.points + [float("inf")]
+        self.between = [self.unbounded | {i for i, lo, hi in ranges if lo <= a and b <= hi}
+                        for a, b in zip(bounds, bounds[1:])]
+
+    def stab(self, v):
+        i = bisect.bisect_left(self.points, v)
+        if i < len(self.points) and self.points[i] == v:
+            return self.at[i]
+        return self.between[i]
+
+
+class RegulationEngine:
+    """Скомпилированные регламенты: код (и его префиксы 2/4/6/8 знаков) -> регламенты,
+    плюс интервальные индексы AC/DC. Цена проверки не зависит от числа регламентов."""
+
+    def __init__(self, regs):
+        self.regs = regs
+        self.by_code = {}
+        for i, reg in enumerate(regs):
+            for code in reg.get("tnved_codes", []):
+                code = digits(code)
+                if code:
+                    self.by_code.setdefault(code, []).append(i)
+        self.lengths = sorted({len(c) for c in self.by_code})
+        everyone = set(range(len(regs)))
+        self.voltage = {}
+        for kind in ("ac", "dc"):
+            ranges = []
+            for i, reg in enumerate(regs):
+                limits = reg.get("voltage_limits") or {}
+                lo, hi = limits.get(f"{kind}_min_v"), limits.get(f"{kind}_max_v")
+                if lo is not None or hi is not None:
+                    ranges.append((i, float("-inf") if lo is None else lo, float("inf") if hi is None else hi))
+            self.voltage[kind] = VoltageIndex(ranges, everyone)
+        # исключённая категория должна входить в категорию товара целыми словами:
+        # «оборудование» не исключает товар из регламента про «медицинское оборудование»
+        self.excluded = [[re.compile(rf"(?<!\w){re.escape(c.strip().lower())}(?!\w)")
+                          for c in reg.get("excluded_categories", []) if c.strip()] for reg in regs]
+
+    def lookup(self, code):
+        """{номер регламента: совпавший префикс} — не больше len(lengths) обращений к словарю."""
+        matched = {}
+        for n in self.lengths:
+            if n > len(code):
+                break
+            for i in self.by_code.get(code[:n], ()):
+                matched[i] = code[:n]
+        return matched
+
+    def check(self, code, voltage=None, kind="ac", category=""):
+        matched = self.lookup(code)
+        fits = self.voltage[kind].stab(voltage) if voltage is not None else None
+        category = category.lower()
+        applicable, rejected = [], []
+        for i, prefix in matched.items():
+            reg = self.regs[i]
+            reason = None
+            if fits is not None and i not in fits:
+                reason = "Напряжение вне диапазона регламента"
+            elif category and any(c.search(category) for c in self.excluded[i]):
+                reason = "Категория продукции исключена из области действия регламента"
+            entry = {"regulation_id": reg.get("regulation_id", ""), "name": reg.get("name", "")}
+            if reason:
+                rejected.append(dict(entry, reason=reason))
+            else:
+                applicable.append(dict(entry, matched=prefix,
+                                       forms=reg.get("conformity_forms", []),
+                                       requirements=reg.get("mandatory_requirements", []),
+                                       documents=reg.get("documents_required", [])))
+        applicable.sort(key=lambda e: -len(e["matched"]))   # точный код раньше товарной позиции
+        return applicable, rejected
+
+
+regulations = RegulationSet(regulation_store, REGULATION_DIR)
+regulation_engine = {"regs": None, "engine": RegulationEngine([])}
+
+def load_regulations():
+    with timed("load_regulation"):
+        return regulations.get()
+
+def regulation_snapshot():
+    """Движок, скомпилированный по текущим файлам регламентов (перекомпилируется при изменении)."""
+    with regulations.lock:
+        regs = load_regulations()
+        cached = regulation_engine["regs"]
+        if cached is None or len(cached) != len(regs) or any(a is not b for a, b in zip(cached, regs)):
+            regulation_engine["engine"] = RegulationEngine(regs)
+            regulation_engine["regs"] = regs
+        return regulation_engine["engine"]
+
+def parse_voltage(voltage):
+    try:
+        return float(voltage.replace(",", "."))
+    except ValueError:
+        return None
+
+def check_regulation(query, voltage, kind="ac", category=""):
+    engine = regulation_snapshot()
+    result = {"applies": False, "reason": ""}
+
+    if not query.isdigit() or len(query) < 6:
+        result["reason"] = "Введите корректный код ТН ВЭД"
+        return result
+
+    applicable, rejected = engine.check(query, parse_voltage(voltage) if voltage else None,
+                                        "dc" if kind == "dc" else "ac", category)
+    if not applicable:
+        result["reason"] = rejected[0]["reason"] if rejected else \
+            "Код ТН ВЭД не входит в область действия регламента"
+        result["rejected"] = rejected
+        return result
+
+    result["applies"] = True
+    result["reason"] = "Подпадает под технический регламент"
+    result["regulation"] = applicable[0]["name"]
+    result["forms"] = applicable[0]["forms"]
+    result["regulations"] = applicable
+    if rejected:
+        result["rejected"] = rejected
+    return result
+
+# ---------- ПОДСКАЗКИ ПРИ НАБОРЕ ----------
+
+SUGGEST_DEPTH = 12      # для префиксов до этой длины top-k хранится готовым
+SUGGEST_TOP = 10
+SUGGEST_SCAN = 200      # длинный префикс: сколько записей просмотреть, не больше
+
+def suggest_norm(s):
+    return " ".join(s.lower().replace("ё", "е").split())
+
+def word_suffixes(s):
+    """«гост р 52350» -> «гост р 52350», «р 52350», «52350»."""
+    yield s
+    for i, ch in enumerate(s):
+        if ch == " ":
+            yield s[i + 1:]
+
+
+class SuggestIndex:
+    """Префиксная структура для автодополнения.
+
+    entries — отсортированный массив (ключ, ранг, подпись, вид, значение), где
+    ключ — подпись целиком и с начала каждого её слова. top — префикс -> уже
+    отобранные лучшие SUGGEST_TOP подписей, поэтому короткий запрос отвечается
+    одним обращением к словарю.
+    """
+
+    def __init__(self, items_fn):
+        self.items_fn = items_fn    # data -> [(gid, label, kind, value, weight)]
+        self.entries = []
+        self.top = {}
+        self.by_id = {}             # gid -> [entry] для удаления записи
+        self.dirty = True
+
+    def on_change(self, key, old, new):
+        if key is None:
+            self.dirty = True
+        elif not self.dirty:
+            self.remove(key)
+            if new is not None:
+                self.add_items(self.items_fn({key: new}))
+
+    def rebuild(self, data):
+        self.entries, self.top, self.by_id = [], {}, {}
+        for gid, label, kind, value, weight in self.items_fn(data):
+            for entry in self._entries(gid, label, kind, value, weight):
+                self.entries.append(entry)
+                self.by_id.setdefault(gid, []).append(entry)
+        self.entries.sort()
+        best = {}
+        for entry in self.entries:
+            for n in range(1, min(len(entry[0]), SUGGEST_DEPTH) + 1):
+                labels = best.setdefault(entry[0][:n], {})
+                if entry[2] not in labels or entry[1] < labels[entry[2]][1]:
+                    labels[entry[2]] = entry
+        for prefix, labels in best.items():
+            self.top[prefix] = sorted(labels.values(), key=lambda e: e[1])[:SUGGEST_TOP]
+        self.dirty = False
+
+    def _entries(self, gid, label, kind, value, weight):
+        rank = (weight, len(label), label)
+        return [(key, rank, label, kind, value, gid)
+                for key in set(word_suffixes(suggest_norm(label))) if key]
+
+    def add_items(self, items):
+        for gid, label, kind, value, weight in items:
+            for entry in self._entries(gid, label, kind, value, weight):
+                bisect.insort(self.entries, entry)
+                self.by_id.setdefault(gid, []).append(entry)
+                for n in range(1, min(len(entry[0]), SUGGEST_DEPTH) + 1):
+                    top = self.top.setdefault(entry[0][:n], [])
+                    if any(e[2] == entry[2] for e in top):
+                        continue
+                    top.append(entry)
+                    top.sort(key=lambda e: e[1])
+                    del top[SUGGEST_TOP:]
+
+    def remove(self, gid):
+        for entry in self.by_id.pop(gid, []):
+            i = bisect.bisect_left(self.entries, entry)
+            if i < len(self.entries) and self.entries[i] == entry:
+                del self.entries[i]
+            for n in range(1, min(len(entry[0]), SUGGEST_DEPTH) + 1):
+                prefix = entry[0][:n]
+                top = self.top.get(prefix)
+                if top and entry in top:
+                    self.top[prefix] = self._scan(prefix, SUGGEST_TOP, limit=None)
+
+    def _scan(self, prefix, k, limit=SUGGEST_SCAN):
+        """Лучшие k по рангу среди записей с ключом на prefix (bisect + просмотр диапазона)."""
+        labels = {}
+        i = bisect.bisect_left(self.entries, (prefix,))
+        seen = 0
+        while i < len(self.entries) and self.entries[i][0].startswith(prefix):
+            entry = self.entries[i]
+            if entry[2] not in labels or entry[1] < labels[entry[2]][1]:
+                labels[entry[2]] = entry
+            i += 1
+            seen += 1
+            if limit is not None and seen >= limit:
+                break
+        return sorted(labels.values(), key=lambda e: e[1])[:k]
+
+    def query(self, q, k):
+        q = suggest_norm(q)
+        if not q:
+            return []
+        if len(q) <= SUGGEST_DEPTH:
+            return self.top.get(q, [])[:k]
+        return self._scan(q, k)
+
+
+def gost_suggest_items(data):
+    for gost, info in data.items():
+        yield gost, gost, "gost", gost, 0
+        mark = info.get("mark", "") if isinstance(info, dict) else ""
+        if mark:
+            yield gost, mark[:80], "mark", gost, 1
+
+def tnved_suggest_items(data):
+    for code, info in data.items():
+        name = info.get("name", "")
+        yield code, code, "tnved", code, 2
+        if name:
+            yield code, name[:80], "tnved_name", code, 3
+
+
+gost_suggest = SuggestIndex(gost_suggest_items)
+tnved_suggest = SuggestIndex(tnved_suggest_items)
+gost_store.listeners.append(gost_suggest.on_change)
+tnved_store.listeners.append(tnved_suggest.on_change)
+
+# ---------- ETag / УСЛОВНЫЙ GET ----------
+
+INDEX_TAG = None    # ETag главной страницы: шаблон меняется только с кодом
+
+def data_etag(stores):
+    return "-".join(f"{name}{store.tag()}" for name, store in stores)
+
+def conditional(*names):
+    """ETag из версий датасетов и ответ 304 на If-None-Match без обращения к данным."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            stores = [(n, {"g": gost_store, "t": tnved_store, "r": regulations}[n]) for n in names]
+            etag = data_etag(stores) if stores else INDEX_TAG
+            if request.if_none_match.contains(etag):
+                resp = make_response("", 304)
+            else:
+                resp = make_response(fn(*args, **kwargs))
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "no-cache"   # хранить можно, но всегда сверять ETag
+            return resp
+        return wrapper
+    return deco
+
+# ---------- КЕШ РЕЗУЛЬТАТОВ ЗАПРОСОВ ----------
+
+QUERY_CACHE_ENTRIES = 1024
+QUERY_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class QueryCache:
+    """LRU: нормализованный запрос -> готовое JSON-тело ответа.
+
+    В ключ входит tag() датасета, а запись в датасет сразу выбрасывает все
+    его записи — устаревший ответ не отдаётся даже до вытеснения по LRU.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()   # key -> (dataset, body, total)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, dataset, body, total):
+        entry = (dataset, body.encode("utf-8"), total)
+        size = len(entry[1])
+        if size > self.max_bytes // 8:
+            return entry        # слишком большой ответ не вытесняет весь кеш
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self.entries[key] = entry
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.bytes -= len(dropped[1])
+        return entry
+
+    def invalidate(self, dataset):
+        """dataset — буква датасета; запись кеша помнит все буквы, от которых зависит."""
+        with self.lock:
+            for key in [k for k, e in self.entries.items() if dataset in e[0]]:
+                self.bytes -= len(self.entries.pop(key)[1])
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+
+query_cache = QueryCache(QUERY_CACHE_ENTRIES, QUERY_CACHE_BYTES)
+gost_store.listeners.append(lambda *change: query_cache.invalidate("g"))
+tnved_store.listeners.append(lambda *change: query_cache.invalidate("t"))
+
+def normalize_query(q):
+    return " ".join(q.lower().split())
+
+def cached_response(entry):
+    _, body, total = entry
+    resp = Response(body, mimetype="application/json")
+    resp.headers["X-Total-Count"] = str(total)
+    return resp
+
+# ---------- ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ И ОГРАНИЧЕНИЕ НАГРУЗКИ ----------
+
+HEAVY_SLOTS = int(os.environ.get("GOST_HEAVY_SLOTS", 2))       # вычислений поиска одновременно (GIL — больше не быстрее)
+HEAVY_WAIT = float(os.environ.get("GOST_HEAVY_WAIT", 5.0))     # секунд ждать слот, затем 503
+HEAVY_QUEUE = int(os.environ.get("GOST_HEAVY_QUEUE", 32))      # ждущих слот больше этого — 503 сразу
+
+
+class Overloaded(Exception):
+    pass
+
+
+class SingleFlight:
+    """Одинаковые одновременные вычисления: первое считает, остальные ждут его результат."""
+
+    class Call:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = self.error = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+        if not leader:
+            metrics.inc("gost_coalesced_total")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+class Admission:
+    """Не больше slots тяжёлых вычислений сразу; в очереди не больше queue, ждать не дольше wait.
+
+    Лишние запросы получают 503 с Retry-After, а не копятся в пуле потоков,
+    где они только делили бы GIL и отвечали всё медленнее.
+    """
+
+    def __init__(self, slots, wait, queue):
+        self.slots = threading.BoundedSemaphore(slots)
+        self.wait = wait
+        self.queue = queue
+        self.lock = threading.Lock()
+        self.waiting = 0
+
+    @contextmanager
+    def slot(self):
+        with self.lock:
+            if self.waiting >= self.queue:
+                raise Overloaded()
+            self.waiting += 1
+        started = time.perf_counter()
+        try:
+            acquired = self.slots.acquire(timeout=self.wait)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        metrics.observe("gost_admission_wait_seconds", time.perf_counter() - started)
+        if not acquired:
+            raise Overloaded()
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+
+single_flight = SingleFlight()
+admission = Admission(HEAVY_SLOTS, HEAVY_WAIT, HEAVY_QUEUE)
+
+def compute_once(key, fn):
+    """Промах кеша: одно вычисление на ключ (single-flight) в слоте admission."""
+    def run():
+        with admission.slot():
+            return fn()
+    return single_flight.do(key, run)
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    metrics.inc("gost_shed_total", endpoint=request.url_rule.endpoint if request.url_rule else "unmatched")
+    resp = jsonify({"success": False, "error": "Сервер перегружен, повторите запрос"})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+@app.errorhandler(RequestEntityTooLarge)
+def too_large(e):
+    limit = request.max_content_length or 0
+    return jsonify({"success": False, "error": f"Запрос больше {limit // (1024 * 1024)} МБ"}), 413
+
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
+def int_arg(name, default, lo=0, hi=None):
+    try:
+        value = int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    value = max(lo, value)
+    return min(value, hi) if hi is not None else value
 
 TEMPLATE_INDEX = """<html>
 <head>
@@ -55,6 +2206,8 @@ button:hover { background: #0056b3; }
 a { text-decoration: none; color: #fff; margin: 0 10px; }
 a:hover { text-decoration: underline; }
 div.result { background: rgba(255,255,255,0.1); padding: 10px; margin-top: 10px; border-radius: 6px; text-align: left; }
+div.result img.thumb { float: right; width: 80px; height: 80px; object-fit: cover; margin-left: 10px; border-radius: 4px; cursor: pointer; }
+div.result::after { content: ""; display: block; clear: both; }
 .mark { color: #00ffcc; font-size: 14px; }
 table { width: 100%; border-collapse: collapse; margin-top: 10px; }
 th, td { padding: 8px; border-bottom: 1px solid #555; text-align: left; }
@@ -247,9 +2400,7 @@ function uploadImage(gost) {
         .then(r => r.json())
         .then(res => {
             if (res.success) {
-            showImage(res.image);
-                delete spaCache["list"];   // ♻️ обновить список
-                loadList();
+                pollImageJob(res.status_url);
             } else {
                 alert(res.error || "Ошибка загрузки");
             }
@@ -259,6 +2410,23 @@ function uploadImage(gost) {
     input.click();
 }
 
+// обработка идёт в фоне — спрашиваем статус, пока задача не завершится
+function pollImageJob(url, delay = 300) {
+    fetch(url)
+        .then(r => r.json())
+        .then(job => {
+            if (job.status === "done") {
+                showImage(job.image);
+                delete spaCache["list"];   // ♻️ обновить список
+                loadList();
+            } else if (job.status === "failed" || job.success === false) {
+                alert(job.error || "Ошибка обработки изображения");
+            } else {
+                setTimeout(() => pollImageJob(url, Math.min(delay * 2, 3000)), delay);
+            }
+        });
+}
+
    
 /* ---------- GLITCH CONTENT ---------- */
 function setAppContent(html) {
@@ -329,11 +2497,12 @@ function setBackground(type) {
 }
 
 /* ---------- SPA: КЕШ СТРАНИЦ ---------- */
-function loadPageCached(url, cacheKey) {
+function loadPageCached(url, cacheKey, after) {
     const app = document.getElementById("app");
 
     if (spaCache[cacheKey]) {
         setAppContent(spaCache[cacheKey]);
+        if (after) setTimeout(after, 170);
         return;
     }
 
@@ -342,6 +2511,7 @@ function loadPageCached(url, cacheKey) {
       .then(html => {
           spaCache[cacheKey] = html;
           setAppContent(html);
+          if (after) setTimeout(after, 170);
       })
       .catch(() => {
           setAppContent("<p>⚠ Ошибка загрузки</p>");
@@ -409,6 +2579,8 @@ function loadAdd() {
               .then(r => r.json())
               .then(res => {
                   if (res.success) {
+                      if (res.duplicates && res.duplicates.length)
+                          alert("⚠ Почти такой же текст уже есть: " + res.duplicates.map(d => d.gost).join(", "));
                       delete spaCache["list"];
                       window.history.pushState(null, "", "/list");
                       loadRoute();
@@ -427,6 +2599,16 @@ function loadAdd() {
 // Функция загрузки списка ГОСТов
 function loadHome() {
     setAppContent(`
+      <h1>🔎 Искать везде</h1>
+      <form id="all-search-form">
+        <input type="text" id="all-input" placeholder="Номер ГОСТа, код ТН ВЭД или наименование..." style="width:55%;">
+        <input type="number" id="all-voltage" placeholder="Напряжение (В)" style="width:15%;">
+        <button type="submit">Искать</button>
+      </form>
+      <div id="all-results"></div>
+
+      <hr style="margin:25px 0;opacity:0.3;">
+
       <h1>🔍 Поиск ГОСТ</h1>
 
       <form id="gost-search-form">
@@ -459,15 +2641,165 @@ function loadHome() {
               searchGost();
           });
 
+        document.getElementById("all-search-form")
+          ?.addEventListener("submit", e => {
+              e.preventDefault();
+              searchAll();
+          });
+
         document.getElementById("tnved-search-btn")
           ?.addEventListener("click", searchTNVED);
 
         document.getElementById("reg-search-btn")
           ?.addEventListener("click", checkRegulation);
+
+        attachSuggest("gost-input", "gost");
+        attachSuggest("tnved-input", "tnved");
     }, 170);
 }
+
+/* ---------- ПОДСКАЗКИ ПРИ НАБОРЕ ---------- */
+function attachSuggest(inputId, src) {
+    const input = document.getElementById(inputId);
+    if (!input) return;
+
+    const list = document.createElement("datalist");
+    list.id = inputId + "-suggest";
+    input.setAttribute("list", list.id);
+    input.setAttribute("autocomplete", "off");
+    input.after(list);
+
+    let timer = null;
+    let controller = null;
+
+    input.addEventListener("input", () => {
+        clearTimeout(timer);
+        if (controller) controller.abort();   // ответ на старый префикс уже не нужен
+        const q = input.value.trim();
+        if (!q) {
+            list.innerHTML = "";
+            return;
+        }
+        timer = setTimeout(() => {
+            controller = new AbortController();
+            fetch(`/api/suggest?src=${src}&q=${encodeURIComponent(q)}`, { signal: controller.signal })
+              .then(r => r.json())
+              .then(items => {
+                  list.innerHTML = "";
+                  items.forEach(item => {
+                      const opt = document.createElement("option");
+                      // по маркировке и наименованию подставляем номер ГОСТа / код
+                      opt.value = (item.kind === "mark" || item.kind === "tnved_name") ? item.value : item.label;
+                      opt.label = item.label;
+                      list.appendChild(opt);
+                  });
+              })
+              .catch(() => {});
+        }, 150);
+    });
+}
 function loadList() {
-    loadPageCached("/api/list-gosts", "list");
+    loadPageCached("/api/list-gosts", "list", watchListMore);
+}
+
+/* ---------- SPA: ДОГРУЗКА СПИСКА ПРИ ПРОКРУТКЕ ---------- */
+let listObserver = null;
+
+function watchListMore() {
+    if (listObserver) listObserver.disconnect();
+    const more = document.querySelector("#app .list-more");
+    if (!more) return;
+
+    listObserver = new IntersectionObserver(entries => {
+        if (!entries[0].isIntersecting) return;
+        listObserver.disconnect();
+
+        fetch("/api/list-gosts?cursor=" + encodeURIComponent(more.dataset.cursor))
+          .then(r => r.text())
+          .then(html => {
+              more.outerHTML = html;
+              spaCache["list"] = document.getElementById("app").innerHTML;
+              watchListMore();
+          })
+          .catch(() => {
+              more.innerHTML = "⚠ Ошибка загрузки";
+          });
+    });
+    listObserver.observe(more);
+}
+
+function showFullText(gost, btn) {
+    fetch("/api/get-gost/" + encodeURIComponent(gost))
+      .then(r => r.json())
+      .then(data => {
+          const card = btn.closest(".result");
+          card.querySelector(".gost-text").textContent = data.text || "";
+          btn.remove();
+      });
+}
+
+function showSimilar(gost, btn) {
+    fetch("/api/similar/" + encodeURIComponent(gost))
+      .then(r => r.json())
+      .then(items => {
+          const list = document.createElement("div");
+          list.className = "similar";
+          list.innerHTML = items.length
+              ? "<b>Похожие:</b><br>" + items.map(it =>
+                    `${it.kind === "gost" ? "ГОСТ" : "ТН ВЭД"} <b>${it.value}</b> (${it.score})`).join("<br>")
+              : "Похожих не найдено";
+          btn.replaceWith(list);
+      });
+}
+
+function esc(s) {
+    return s.replace(/[&<>"']/g, ch => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"})[ch]);
+}
+
+// Подсветка по смещениям [[от, до]], посчитанным сервером
+function highlight(text, spans) {
+    let out = "", pos = 0;
+    for (const [from, to] of spans) {
+        out += esc(text.slice(pos, from)) + "<mark>" + esc(text.slice(from, to)) + "</mark>";
+        pos = to;
+    }
+    return out + esc(text.slice(pos));
+}
+
+// Единый поиск: ГОСТ, ТН ВЭД и техрегламент одним запросом
+function searchAll() {
+    const q = document.getElementById("all-input").value.trim();
+    const v = document.getElementById("all-voltage").value.trim();
+    const box = document.getElementById("all-results");
+    box.innerHTML = "";
+    if (!q) return;
+    const labels = {gost: "ГОСТ", tnved: "ТН ВЭД", regulation: "Техрегламент"};
+    fetch(`/api/search-all?q=${encodeURIComponent(q)}&v=${encodeURIComponent(v)}`)
+      .then(r => r.json())
+      .then(data => {
+          let html = "";
+          for (const [name, src] of Object.entries(data.sources)) {
+              if (src.status === "timeout" || src.status === "overloaded" || src.status === "error")
+                  html += `<p>⏳ ${labels[name]}: не успел ответить, повторите поиск</p>`;
+              else if (name === "regulation" && src.status === "ok" && !src.total)
+                  html += `<p>⚖ ${esc(src.reason || "")}</p>`;
+          }
+          if (!data.results.length) html += "<p>❌ Ничего не найдено</p>";
+          for (const it of data.results) {
+              let body = "";
+              if (it.source === "gost")
+                  body = `${it.offset ? "…" : ""}${highlight(it.text || "", it.highlights || [])}`;
+              else if (it.source === "tnved" && it.gosts.length)
+                  body = "<b>ГОСТ:</b> " + it.gosts.map(esc).join(", ");
+              else if (it.source === "regulation")
+                  body = "<b>Формы:</b> " + esc((it.forms || []).join(", "));
+              html += `<div class="result"><span class="mark">${labels[it.source]}</span> <b>${esc(it.key)}</b> ${esc(it.title || "")}<br>${body}</div>`;
+          }
+          box.innerHTML = html;
+      })
+      .catch(() => {
+          box.innerHTML = "<p>⚠ Ошибка запроса</p>";
+      });
 }
 
 // Функция поиска ГОСТ
@@ -476,19 +2808,32 @@ function searchGost() {
     const box = document.getElementById("gost-search-results");
     box.innerHTML = "";
     if (!q) return;
+    let total = 0;
     fetch("/api/search?q=" + encodeURIComponent(q))
-      .then(r => r.json())
+      .then(r => {
+          total = parseInt(r.headers.get("X-Total-Count") || "0", 10);
+          return r.json();
+      })
       .then(data => {
           if (!data || Object.keys(data).length === 0) {
               box.innerHTML = "<p>❌ Ничего не найдено</p>";
               return;
           }
+          const shown = Object.keys(data).length;
           let html = "<h2>Результаты:</h2>";
+          if (total > shown) html += `<p>Показано ${shown} из ${total}</p>`;
           for (const gost in data) {
               const info = data[gost];
-              const text = info.text || "";
-              const mark = info.mark || "";
-              html += `<div class="result"><b>${gost}</b> <span class="mark">(${mark})</span><br>${text}</div>`;
+              const text = highlight(info.text || "", info.highlights || []);
+              const mark = esc(info.mark || "");
+              const gostArg = `decodeURIComponent('${encodeURIComponent(gost)}')`;
+              const codes = info.tnved && info.tnved.length
+                  ? `<br><b>ТН ВЭД:</b> ${info.tnved.join(", ")}` : "";
+              const more = info.has_more
+                  ? `<button onclick="showFullText(${gostArg}, this)">📄 Полностью</button> ` : "";
+              html += `<div class="result"><b>${esc(gost)}</b> <span class="mark">(${mark})</span><br>`
+                    + `<span class="gost-text">${info.offset ? "…" : ""}${text}</span>${codes}`
+                    + `<br>${more}<button onclick="showSimilar(${gostArg}, this)">Похожие</button></div>`;
           }
           box.innerHTML = html;
       })
@@ -504,14 +2849,19 @@ function searchTNVED() {
     const q = input.value.trim();
     box.innerHTML = "";
     if (!q) return;
+    let total = 0;
     fetch("/api/tnved?q=" + encodeURIComponent(q))
-        .then(r => r.json())
+        .then(r => {
+            total = parseInt(r.headers.get("X-Total-Count") || "0", 10);
+            return r.json();
+        })
         .then(data => {
             if (!data || Object.keys(data).length === 0) {
                 box.innerHTML = "<p>❌ Ничего не найдено</p>";
                 return;
             }
-            let html = "";
+            const shown = Object.keys(data).length;
+            let html = total > shown ? `<p>Показано ${shown} из ${total}</p>` : "";
             for (const code in data) {
                 const item = data[code];
                 html += `<div class="result"><b>КОД ТН ВЭД:</b> ${code}<br><b>Наименование:</b> ${item.name || ""}`;
@@ -520,6 +2870,9 @@ function searchTNVED() {
                     item.standards.forEach(s => html += `<li>${s}</li>`);
                     html += "</ul>";
                 }
+                if (item.gosts && item.gosts.length) {
+                    html += `<b>В базе:</b> ${item.gosts.join(", ")}`;
+                }
                 html += "</div>";
             }
             box.innerHTML = html;
@@ -546,13 +2899,18 @@ function checkRegulation() {
                 box.innerHTML = `<p style="color:#ff6b6b;">❌ ${data.reason}</p>`;
                 return;
             }
-            box.innerHTML = `
+            let html = "";
+            (data.regulations || []).forEach(reg => {
+                html += `
               <div class="result">
                 <b style="color:#90ee90;">✅ Подпадает под техрегламент</b><br>
-                Регламент: ${data.regulation || ""}<br>
-                Формы: ${data.forms || ""}
+                Регламент: ${reg.name || ""}<br>
+                Формы: ${(reg.forms || []).join(", ")}<br>
+                Документы: ${(reg.documents || []).join(", ")}
               </div>
             `;
+            });
+            box.innerHTML = html;
         })
         .catch(() => {
             box.innerHTML = "<p>⚠ Ошибка проверки</p>";
@@ -601,21 +2959,152 @@ document.addEventListener('DOMContentLoaded', function() {
 </body>
 </html>"""
 
+INDEX_TAG = hashlib.sha1(TEMPLATE_INDEX.encode("utf-8")).hexdigest()[:16]
+
 @app.route("/")
+@conditional()
 def index():
     return render_template_string(TEMPLATE_INDEX)
 
-from werkzeug.utils import secure_filename
-
 UPLOAD_FOLDER = "static/uploads"
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# ---------- ИЗОБРАЖЕНИЯ: ФОНОВАЯ ОБРАБОТКА ----------
+#
+# Загрузка только проверяет запрос и ставит задачу; пул потоков проверяет
+# содержимое (Pillow), убирает метаданные, пересохраняет и делает копии
+# IMAGE_SIZES. Имена файлов — хеш содержимого загрузки: одинаковые картинки
+# не дублируются, а /media/ отдаёт их с Cache-Control: immutable. Состояние
+# задачи лежит файлом в IMAGE_JOBS_DIR — его видит любой воркер gunicorn.
+
+IMAGE_WORKERS = int(os.environ.get("GOST_IMAGE_WORKERS", 2))
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_FORM_OVERHEAD = 64 * 1024     # поля формы и заголовки multipart сверх самого файла
+IMAGE_MAX_PIXELS = 40_000_000       # больше — похоже на «декомпрессионную бомбу»
+IMAGE_SIZES = {"thumb": 160, "preview": 800, "full": 2000}     # длинная сторона, px
+IMAGE_QUALITY = 85
+IMAGE_JOBS_DIR = os.path.join(UPLOAD_FOLDER, ".jobs")
+IMAGE_JOB_TTL = 24 * 3600
+IMAGE_SIGNATURES = ((b"\x89PNG\r\n\x1a\n", "png"), (b"\xff\xd8\xff", "jpg"), (b"RIFF", "webp"))
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+image_pool = None       # создаётся в процессе-воркере при первой загрузке
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+def image_kind(raw):
+    """png / jpg / webp по сигнатуре файла или None."""
+    for magic, kind in IMAGE_SIGNATURES:
+        if raw.startswith(magic) and (kind != "webp" or raw[8:12] == b"WEBP"):
+            return kind
+    return None
+
+def job_path(job_id):
+    return os.path.join(IMAGE_JOBS_DIR, job_id + ".json")
+
+def write_job(job_id, **state):
+    tmp = f"{job_path(job_id)}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dict(state, job=job_id, updated=time.time()), f, ensure_ascii=False)
+    os.replace(tmp, job_path(job_id))
+
+def prune_jobs():
+    cutoff = time.time() - IMAGE_JOB_TTL
+    with os.scandir(IMAGE_JOBS_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+def render_images(raw, digest):
+    """{размер: имя файла} в UPLOAD_FOLDER; ValueError — не картинка или слишком большая."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        # без Pillow: только проверка сигнатуры, один файл на все размеры
+        kind = image_kind(raw)
+        if kind is None:
+            raise ValueError("Файл не является изображением PNG, JPEG или WebP")
+        name = f"{digest}.{kind}"
+        with open(os.path.join(UPLOAD_FOLDER, name), "wb") as f:
+            f.write(raw)
+        return {size: name for size in IMAGE_SIZES}
+
+    Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+    try:
+        with Image.open(io.BytesIO(raw)) as probe:
+            if probe.format not in ("PNG", "JPEG", "WEBP"):
+                raise ValueError("Допустимы только PNG, JPEG и WebP")
+            probe.verify()
+        img = Image.open(io.BytesIO(raw))
+        # Pillow сам ругается только на 2 × MAX_IMAGE_PIXELS, а до этого лишь предупреждает
+        width, height = img.size
+        if width * height > IMAGE_MAX_PIXELS:
+            raise ValueError(f"Изображение больше {IMAGE_MAX_PIXELS // 1_000_000} Мпикс: {width}×{height}")
+        img.load()
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Повреждённое или слишком большое изображение: {e}")
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        # прозрачность — на белый фон, как у страниц списка
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img.convert("RGBA"), mask=img.convert("RGBA").getchannel("A"))
+        img = background
+    names = {}
+    for size, edge in IMAGE_SIZES.items():
+        name = f"{digest}-{size}.jpg"
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if not os.path.exists(path):        # та же картинка уже загружалась
+            copy = img.copy()
+            copy.thumbnail((edge, edge), Image.LANCZOS)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            copy.save(tmp, "JPEG", quality=IMAGE_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp, path)
+        names[size] = name
+    return names
+
+def process_image(job_id, gost, raw):
+    digest = hashlib.sha256(raw).hexdigest()[:20]
+    write_job(job_id, gost=gost, status="processing")
+    try:
+        with timed("image_process"):
+            names = render_images(raw, digest)
+    except ValueError as e:
+        write_job(job_id, gost=gost, status="failed", error=str(e))
+        metrics.inc("gost_image_jobs_total", status="failed")
+        return
+    except Exception as e:
+        write_job(job_id, gost=gost, status="failed", error=f"Ошибка обработки: {e}")
+        metrics.inc("gost_image_jobs_total", status="failed")
+        raise
+    urls = {size: "/media/" + name for size, name in names.items()}
+    with gost_store.lock:
+        info = load_data().get(gost)
+        if info is None:
+            write_job(job_id, gost=gost, status="failed", error="ГОСТ удалён во время обработки")
+            metrics.inc("gost_image_jobs_total", status="failed")
+            return
+        info = info if isinstance(info, dict) else {"text": str(info), "mark": ""}
+        gost_store.put(gost, dict(info, image=urls["preview"], thumb=urls["thumb"], image_full=urls["full"]))
+    write_job(job_id, gost=gost, status="done", images=urls, image=urls["preview"])
+    metrics.inc("gost_image_jobs_total", status="done")
+
+def image_executor():
+    global image_pool
+    if image_pool is None:
+        image_pool = ThreadPoolExecutor(IMAGE_WORKERS, thread_name_prefix="images")
+    return image_pool
+
 
 @app.route("/api/upload-gost-image", methods=["POST"])
 def upload_gost_image():
+    """Ставит загрузку в очередь: 202 и id задачи; готовность — /api/image-jobs/<id>."""
+    # предел ставится до разбора формы: иначе Werkzeug успеет сохранить всё тело
+    request.max_content_length = IMAGE_MAX_BYTES + IMAGE_FORM_OVERHEAD
     gost = request.form.get("gost")
     file = request.files.get("image")
 
@@ -625,34 +3114,77 @@ def upload_gost_image():
     if not allowed_file(file.filename):
         return {"success": False, "error": "Недопустимый формат"}
 
-    filename = secure_filename(f"{gost}.jpg")
-    path = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(path)
-
-    data = load_data()
-    if gost not in data:
+    if gost not in load_data():
         return {"success": False, "error": "ГОСТ не найден"}
 
-    data[gost]["image"] = "/" + path.replace("\\", "/")
-    save_data(data)
-
-    return {"success": True, "image": data[gost]["image"]}
+    raw = file.read(IMAGE_MAX_BYTES + 1)
+    if len(raw) > IMAGE_MAX_BYTES:
+        return {"success": False, "error": f"Файл больше {IMAGE_MAX_BYTES // (1024 * 1024)} МБ"}, 413
+    if image_kind(raw) is None:
+        return {"success": False, "error": "Файл не является изображением PNG, JPEG или WebP"}
+
+    os.makedirs(IMAGE_JOBS_DIR, exist_ok=True)
+    prune_jobs()
+    job_id = uuid.uuid4().hex
+    write_job(job_id, gost=gost, status="queued")
+    image_executor().submit(process_image, job_id, gost, raw)
+    metrics.inc("gost_image_jobs_total", status="queued")
+    return {"success": True, "job": job_id, "status": "queued",
+            "status_url": f"/api/image-jobs/{job_id}"}, 202
+
+@app.route("/api/image-jobs/<job_id>")
+def api_image_job(job_id):
+    if not JOB_ID_RE.fullmatch(job_id):
+        return jsonify({"success": False, "error": "Неверный id задачи"}), 400
+    try:
+        with open(job_path(job_id), encoding="utf-8") as f:
+            return jsonify(json.load(f))
+    except FileNotFoundError:
+        return jsonify({"success": False, "error": "Задача не найдена"}), 404
+
+@app.route("/media/<name>")
+def media(name):
+    """Файлы с хешем содержимого в имени не меняются — кешируются навсегда."""
+    resp = send_from_directory(UPLOAD_FOLDER, name, max_age=MEDIA_MAX_AGE)
+    resp.headers["Cache-Control"] = f"public, max-age={MEDIA_MAX_AGE}, immutable"
+    return resp
+
+LIST_PAGE = 50
+LIST_MAX_PAGE = 200
+LIST_SNIPPET = 300   # символов текста в списке; полный текст — через /api/get-gost
 
 @app.route("/api/list-gosts")
+@conditional("g")
 def api_list_gosts():
-    data = load_data()
-    html = "<h2>📋 Список ГОСТов</h2>"
-
-    for gost, info in data.items():
-        text = info.get("text", "")
-        mark = info.get("mark", "")
-        image = info.get("image", "/static/images/no-image.png")
-
-        html += f"""
+    cursor = request.args.get("cursor", "")
+    limit = int_arg("limit", LIST_PAGE, 1, LIST_MAX_PAGE)
+    with gost_store.lock:
+        data = gost_snapshot()
+        keys, more = gost_index.page(cursor, limit)
+
+    def generate():
+        if not cursor:
+            yield "<h2>📋 Список ГОСТов</h2>"
+
+        for gost in keys:
+            info = data[gost]
+            text = info.get("text", "")
+            mark = info.get("mark", "")
+            image = info.get("image", "/static/images/no-image.png")
+            thumb = info.get("thumb")
+            thumb = f"""<img class="thumb" src="{thumb}" loading="lazy" alt="" onclick="showImage('{image}')">""" if thumb else ""
+
+            full = ""
+            if len(text) > LIST_SNIPPET:
+                text = text[:LIST_SNIPPET] + "…"
+                full = f"""<button onclick="showFullText('{gost}', this)">📄 Полностью</button>"""
+
+            yield f"""
 <div class="result">
-  <b>{gost}</b> <span class="mark">({mark})</span><br>
-  {text}<br><br>
+  {thumb}<b>{gost}</b> <span class="mark">({mark})</span><br>
+  <span class="gost-text">{text}</span><br><br>
 
+  {full}
   <button onclick="showImage('{image}')">👁 Показать</button>
   <button onclick="uploadImage('{gost}')">🖼 Изображение</button>
   <button onclick="editGost('{gost}')">✏️ Редактировать</button>
@@ -662,55 +3194,141 @@ def api_list_gosts():
 </div>
         """
 
-    return html
+        if more:
+            yield f"""<div class="list-more" data-cursor="{html.escape(keys[-1])}">⏳ Загрузка...</div>"""
+
+    return Response(generate(), mimetype="text/html")
 
 @app.route("/api/get-gost/<gost>")
+@conditional("g")
 def api_get_gost(gost):
     data = load_data()
     return data.get(gost, {})
 
+def near_duplicates(gost, text):
+    """Записи с почти тем же текстом — предупреждение для формы, запись не блокируется."""
+    gost_snapshot()
+    with gost_store.lock:
+        return [{"gost": g, "similarity": sim} for g, sim in gost_dups.near(text, exclude=gost)]
+
 @app.route("/api/update-gost", methods=["POST"])
 def api_update_gost():
-    data = load_data()
     j = request.json
     gost = j.get("number")
 
-    if gost not in data:
-        return {"ok": False}
-
-    data[gost] = {
-        "mark": j.get("mark", ""),
-        "text": j.get("text", "")
-    }
-
-    save_data(data)
-    return {"ok": True}
+    with gost_store.lock:
+        info = load_data().get(gost)
+        if info is None:
+            return {"ok": False}
+        # правка меняет маркировку и текст; картинки от обработчика изображений остаются
+        info = info if isinstance(info, dict) else {"text": str(info), "mark": ""}
+        gost_store.put(gost, dict(info, mark=j.get("mark", ""), text=j.get("text", "")))
+    return {"ok": True, "duplicates": near_duplicates(gost, j.get("text", ""))}
 
 @app.route("/api/delete-gost/<gost>")
 def api_delete_gost(gost):
-    data = load_data()
-    if gost in data:
-        del data[gost]
-        save_data(data)
+    gost_store.put(gost, None)
     return {"ok": True}
 
+SEARCH_SNIPPET = 240        # символов текста вокруг первого совпадения
+SEARCH_MARK = 200
+SEARCH_BUDGET = int(os.environ.get("GOST_SEARCH_BUDGET", 64 * 1024))   # байт JSON на страницу выдачи
+
+def snippet(text, text_l, q, width=SEARCH_SNIPPET):
+    """Окно текста вокруг первого вхождения q: (фрагмент, начало в тексте, [[от, до]] вхождений во фрагменте).
+
+    text_l — текст в нижнем регистре из поискового индекса (та же длина, что text).
+    """
+    pos = text_l.find(q) if q else -1
+    start = 0
+    if pos > 0 and len(text) > width:
+        start = max(0, min(pos - width // 3, len(text) - width))
+        space = text.rfind(" ", max(0, start - 20), start)
+        if space >= 0:
+            start = space + 1       # не режем слово в начале окна
+    end = min(len(text), start + width)
+    if end < len(text):
+        space = text.find(" ", end, end + 20)
+        if space >= 0:
+            end = space
+    highlights = []
+    if q:
+        i = text_l.find(q, start, end)
+        while i >= 0 and i + len(q) <= end:
+            highlights.append([i - start, i - start + len(q)])
+            i = text_l.find(q, i + len(q), end)
+    return text[start:end], start, highlights
+
+def search_gosts(q, limit, offset=0):
+    """Ранжированный поиск ГОСТов: ({gost: {фрагмент текста, mark, …}}, всего найдено).
+
+    Полный текст — через /api/get-gost; страница ограничена SEARCH_BUDGET байтами.
+    """
+    results = {}
+    scan = {}
+    with gost_store.lock, timed("search_gost"):
+        data = gost_snapshot()
+        hits = gost_index.search(q, scan, top=offset + limit)
+        total = scan["matched"]
+        # номер, найденный подстрокой, стоит первым — опечатки в нём искать незачем
+        found = bool(hits) and q in gost_index.docs[hits[0][0]][0]
+        fuzzy = gost_numbers.match(q, typos=not found)
+        if fuzzy:
+            # номера, которых нет среди подстрочных совпадений, добавляются к итогу
+            total += sum(1 for gost in fuzzy if q not in gost_index.docs[gost][3])
+    metrics.inc("gost_records_scanned_total", scan["scanned"], search="gost")
+    if fuzzy:
+        # тот же номер в другом написании — почти как точное совпадение,
+        # опечатка в 1–2 символа — ниже совпадений по маркировке
+        scores = dict(hits)
+        for gost, d in fuzzy.items():
+            scores[gost] = max(scores.get(gost, 0), 900 if d == 0 else 120 - 40 * d)
+        hits = heapq.nsmallest(offset + limit, scores.items(), key=lambda h: (-h[1], h[0]))
+    page = hits[offset:offset + limit]
+    tnved_snapshot()
+    with gost_store.lock:
+        links = {gost: crossref.codes_for(gost) for gost, _ in page}
+        docs = {gost: gost_index.docs.get(gost) for gost, _ in page}
+    size = 0
+    for gost, _ in page:
+        info = data[gost]
+        if isinstance(info, dict):
+            text, mark = info.get("text", ""), info.get("mark", "")
+        else:
+            text, mark = str(info), ""
+        doc = docs[gost]
+        text_l = doc[2] if doc and len(doc[2]) == len(text) else text.lower()
+        cut, start, highlights = snippet(text, text_l, q)
+        result = {"text": cut, "offset": start, "highlights": highlights,
+                  "mark": mark[:SEARCH_MARK],
+                  "has_more": len(cut) < len(text) or len(mark) > SEARCH_MARK,
+                  "tnved": links[gost][:CROSSREF_LINKS]}
+        size += len(app.json.dumps({gost: result}).encode("utf-8"))
+        if results and size > SEARCH_BUDGET:
+            break       # остальное — следующей страницей (offset + число полученных)
+        results[gost] = result
+    metrics.inc("gost_records_returned_total", len(results), search="gost")
+    return results, total
+
+def gost_search_cached(q, limit, offset=0):
+    """Ответ поиска ГОСТов из кеша или одним вычислением на все одинаковые запросы."""
+    key = ("search", q, limit, offset, gost_store.tag(), tnved_store.tag())
+    hit = query_cache.get(key)
+    if hit is None:
+        def compute():
+            results, total = search_gosts(q, limit, offset) if q else ({}, 0)
+            with timed("render"):
+                return query_cache.put(key, "gt", app.json.dumps(results), total)
+        hit = compute_once(key, compute)
+    return hit
+
 @app.route("/api/search")
+@conditional("g", "t")
 def api_search():
-    q = request.args.get("q", "").strip().lower()
-    data = load_data()
-    results = {}
-    if q:
-        for gost, info in data.items():
-            if isinstance(info, dict):
-                text = info.get("text", "")
-                mark = info.get("mark", "")
-            else:
-                text = str(info)
-                mark = ""
-            combined = f"{gost} {mark} {text}".lower()
-            if q in combined:
-                results[gost] = {"text": text, "mark": mark}
-    return jsonify(results)
+    q = normalize_query(request.args.get("q", ""))
+    limit = int_arg("limit", SEARCH_LIMIT, 1, SEARCH_MAX_LIMIT)
+    offset = int_arg("offset", 0)
+    return cached_response(gost_search_cached(q, limit, offset))
 
 @app.route("/api/add-gost", methods=["POST"])
 def api_add_gost():
@@ -721,58 +3339,869 @@ def api_add_gost():
     gost_mark = data_json.get("gost_mark", "").strip()
     gost_text = data_json.get("gost_text", "").strip()
     if gost_number:
-        data = load_data()
-        data[gost_number] = {"text": gost_text, "mark": gost_mark}
-        save_data(data)
-        return jsonify({"success": True})
+        gost_store.put(gost_number, {"text": gost_text, "mark": gost_mark})
+        return jsonify({"success": True, "duplicates": near_duplicates(gost_number, gost_text)})
     else:
         return jsonify({"success": False, "error": "Неверный номер ГОСТ"}), 400
 
+def search_tnved(query, limit):
+    """Код — поиск по префиксу, иначе по словам наименования: ({code: info}, всего)."""
+    data = tnved_snapshot()
+    code = tnved_code(query)
+    with timed("search_tnved"):
+        if code:
+            total, codes = tnved_index.prefix(code, limit)
+        else:
+            total, codes = tnved_index.name_search(query, limit)
+    metrics.inc("gost_records_scanned_total", total, search="tnved")
+    metrics.inc("gost_records_returned_total", len(codes), search="tnved")
+    gost_snapshot()
+    with gost_store.lock:
+        return {c: dict(data[c], gosts=crossref.gosts_for(c)) for c in codes}, total
+
+def tnved_search_cached(query, limit):
+    key = ("tnved", query, limit, tnved_store.tag(), gost_store.tag())
+    hit = query_cache.get(key)
+    if hit is None:
+        def compute():
+            results, total = search_tnved(query, limit) if query else ({}, 0)
+            with timed("render"):
+                return query_cache.put(key, "tg", app.json.dumps(results), total)
+        hit = compute_once(key, compute)
+    return hit
+
 @app.route("/api/tnved")
+@conditional("t", "g")
 def api_tnved():
-    query = request.args.get("q", "").strip().lower()
-    data = load_tnved()
-    results = {}
-    if query:
-        for code, info in data.items():
-            name = info.get("name", "")
-            combined = f"{code} {name}".lower()
-            if query in combined:
-                results[code] = info
-    return jsonify(results)
+    query = normalize_query(request.args.get("q", ""))
+    limit = int_arg("limit", TNVED_LIMIT, 1, TNVED_MAX_LIMIT)
+    return cached_response(tnved_search_cached(query, limit))
+
+@app.route("/api/tnved-tree")
+@conditional("t")
+def api_tnved_tree():
+    code = tnved_code(request.args.get("code", "").strip()) or ""
+    tnved_snapshot()
+    path = [{"code": code[:n], "count": tnved_index.count(code[:n])}
+            for n in TNVED_LEVELS if n <= len(code)]
+    children = [{"code": c, "count": n} for c, n in tnved_index.children(code)]
+    return jsonify({"path": path, "children": children})
 
 @app.route("/api/regulation-check")
+@conditional("r")
 def api_regulation_check():
     query = request.args.get("q", "").strip()
     voltage = request.args.get("v", "").strip()
-    reg = load_regulation()
-
-    result = {"applies": False, "reason": ""}
+    kind = request.args.get("kind", "ac")
+    category = request.args.get("cat", "").strip()
+    return jsonify(check_regulation(query, voltage, kind, category))
+
+# ---------- ЕДИНЫЙ ПОИСК: ГОСТ + ТН ВЭД + ТЕХРЕГЛАМЕНТ ----------
+
+SEARCH_ALL_LIMIT = 10
+SEARCH_ALL_MAX_LIMIT = 100
+SEARCH_ALL_THREADS = 8
+SEARCH_ALL_BUDGETS = {"gost": 1.0, "tnved": 0.5, "regulation": 0.5}    # секунд на источник
+SEARCH_ALL_RRF = 10     # k в reciprocal rank fusion: 1 / (k + место в источнике)
+
+search_pool = None      # создаётся в процессе-воркере при первом запросе
+
+def search_all_pool():
+    global search_pool
+    if search_pool is None:
+        search_pool = ThreadPoolExecutor(SEARCH_ALL_THREADS, thread_name_prefix="search-all")
+    return search_pool
+
+def search_all_sources(q, voltage, limit):
+    """{источник: функция -> [элемент выдачи], (итого, причина)}; источник без смысла для q — None."""
+    code = tnved_code(q)
+
+    def gost():
+        _, body, total = gost_search_cached(q, limit)
+        return [{"source": "gost", "key": g, "title": info["mark"], "text": info["text"],
+                 "offset": info["offset"], "highlights": info["highlights"], "has_more": info["has_more"]}
+                for g, info in json.loads(body).items()], total, None
+
+    def tnved():
+        _, body, total = tnved_search_cached(q, limit)
+        return [{"source": "tnved", "key": c, "title": info.get("name", ""), "gosts": info.get("gosts", [])}
+                for c, info in json.loads(body).items()], total, None
+
+    def regulation():
+        result = check_regulation(code, voltage)
+        items = [{"source": "regulation", "key": entry.get("regulation_id", entry["name"]),
+                  "title": entry["name"], "forms": entry.get("forms", []), "matched": entry.get("matched", "")}
+                 for entry in result.get("regulations", [])]
+        return items, len(items), result["reason"]
+
+    return {"gost": gost, "tnved": tnved,
+            "regulation": regulation if code and len(code) >= 6 else None}
+
+def fuse(ranked, weights):
+    """Один список из выдач источников: reciprocal rank fusion с весом источника."""
+    merged = []
+    for name, items in ranked.items():
+        for rank, item in enumerate(items):
+            merged.append((weights.get(name, 1.0) / (SEARCH_ALL_RRF + rank), name, rank, item))
+    merged.sort(key=lambda m: (-m[0], m[2], m[1]))
+    return [dict(item, score=round(score, 5)) for score, _, _, item in merged]
+
+@app.route("/api/search-all")
+@conditional("g", "t", "r")
+def api_search_all():
+    """ГОСТы, ТН ВЭД и техрегламент параллельно; каждый источник ждём не дольше своего бюджета.
+
+    Не успевший источник помечается timeout, а его вычисление доходит в фоне
+    и попадает в кеш запросов — следующий такой же запрос получит всё.
+    """
+    q = normalize_query(request.args.get("q", ""))
+    voltage = request.args.get("v", "").strip()
+    limit = int_arg("limit", SEARCH_ALL_LIMIT, 1, SEARCH_ALL_MAX_LIMIT)
+    budget_ms = int_arg("budget_ms", 0, 0, 10000)
+    if not q:
+        return jsonify({"query": q, "partial": False, "sources": {}, "results": []})
+    started = time.perf_counter()
+    pool = search_all_pool()
+    futures = {}
+    sources = {}
+    for name, fn in search_all_sources(q, voltage, limit).items():
+        if fn is None:
+            sources[name] = {"status": "skipped"}
+        else:
+            futures[name] = pool.submit(fn)
+    ranked = {}
+    for name, future in futures.items():
+        budget = budget_ms / 1000 if budget_ms else SEARCH_ALL_BUDGETS[name]
+        try:
+            items, total, reason = future.result(timeout=max(0.0, started + budget - time.perf_counter()))
+        except FutureTimeout:
+            sources[name] = {"status": "timeout"}
+        except Overloaded:
+            sources[name] = {"status": "overloaded"}
+        except Exception as e:
+            sources[name] = {"status": "error", "error": str(e)}
+        else:
+            ranked[name] = items
+            sources[name] = {"status": "ok", "total": total}
+            if reason:
+                sources[name]["reason"] = reason
+        sources[name]["ms"] = round((time.perf_counter() - started) * 1000, 1)
+        metrics.inc("gost_search_all_sources_total", source=name, status=sources[name]["status"])
+    # запрос-код — в первую очередь про ТН ВЭД и регламент, похожий на номер — про ГОСТ
+    weights = {"regulation": 3.0, "tnved": 2.0} if tnved_code(q) else {}
+    if "gost" in ranked and any(item["key"].lower() == q for item in ranked["gost"]):
+        weights["gost"] = 3.0
+    partial = any(src["status"] not in ("ok", "skipped") for src in sources.values())
+    return jsonify({"query": q, "partial": partial, "sources": sources,
+                    "results": fuse(ranked, weights)})
+
+# ---------- ПАКЕТНАЯ ПРОВЕРКА ПО ТЕХРЕГЛАМЕНТУ ----------
+
+CODE_HEADERS = ("код", "code", "kod", "тн вэд", "tn ved", "tnved")
+VOLTAGE_HEADERS = ("напряж", "voltage", "kuchlanish", "(в)", "v)")
+BATCH_COLUMNS = ["row", "code", "voltage", "applies", "reason", "regulation", "forms"]
+
+def cell_str(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+def table_rows(rows):
+    """(code, voltage) из строк таблицы: первая строка — всегда заголовок, как в «Tris Shablon.xlsx».
+
+    Колонки ищутся по заголовку; если он их не называет, берутся первые две колонки.
+    """
+    rows = iter(rows)
+    head = [cell_str(c).lower() for c in next(rows, ())]
+    code_hit = [i for i, h in enumerate(head) if any(k in h for k in CODE_HEADERS)]
+    volt_hit = [i for i, h in enumerate(head) if any(k in h for k in VOLTAGE_HEADERS)]
+    code_col = code_hit[0] if code_hit else 0
+    volt_col = volt_hit[0] if volt_hit else (1 if code_col != 1 else 0)
+    for row in rows:
+        cells = [cell_str(c) for c in row]
+        if not any(cells):
+            continue
+        code = cells[code_col] if code_col < len(cells) else ""
+        voltage = cells[volt_col] if volt_col < len(cells) else ""
+        yield code, voltage
+
+def json_rows(items):
+    for item in items:
+        if isinstance(item, dict):
+            code = item.get("code", item.get("q", ""))
+            voltage = item.get("voltage", item.get("v", ""))
+        elif isinstance(item, (list, tuple)):
+            code = item[0] if item else ""
+            voltage = item[1] if len(item) > 1 else ""
+        else:
+            code, voltage = item, ""
+        yield cell_str(code), cell_str(voltage)
+
+def csv_cell(value):
+    """Список строк -> «a; b»; прочие вложенные значения — JSON, а не repr."""
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return "; ".join(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+def csv_stream(columns, rows):
+    """Строки-словари -> куски CSV; в файл попадают только колонки columns."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: csv_cell(row.get(k, "")) for k in columns})
+        if buf.tell() >= 64 * 1024:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def ndjson_stream(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+def upload_copy(stream):
+    """Копия загрузки во временном файле: Flask закрывает request.files
+    сразу после view-функции, а строки читаются уже во время стриминга ответа."""
+    src = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, src)
+    src.seek(0)
+    return src
+
+def xlsx_rows(stream):
+    """Строки первого листа. Книга открывается сразу: не-XLSX даёт ValueError
+    (ответ 400), а не обрыв уже начатого потокового ответа."""
+    try:
+        import openpyxl
+        from openpyxl.utils.exceptions import InvalidFileException
+    except ImportError:
+        stream.close()
+        raise ValueError("Для XLSX нужен пакет openpyxl")
+    try:
+        wb = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError):
+        stream.close()
+        raise ValueError("Файл не является книгой XLSX")
+
+    def rows():
+        try:
+            yield from wb.worksheets[0].iter_rows(values_only=True)
+        finally:
+            wb.close()
+            stream.close()
+    return rows()
+
+def csv_rows(stream):
+    """Строки CSV в UTF-8. Кодировка всего файла проверяется сразу — до начала ответа."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for chunk in iter(lambda: stream.read(64 * 1024), b""):
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        stream.close()
+        raise ValueError("CSV должен быть в кодировке UTF-8")
+    stream.seek(0)
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    sample = text.readline()
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+
+    def rows():
+        try:
+            yield from csv.reader(_chain_line(sample, text), dialect=dialect)
+        finally:
+            text.close()
+    return rows()
+
+def _chain_line(first, rest):
+    yield first
+    yield from rest
+
+def batch_input():
+    """Генератор (code, voltage) из JSON-массива, CSV или XLSX загрузки."""
+    file = request.files.get("file")
+    if file is None:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise ValueError("Ожидается JSON-массив или файл CSV/XLSX")
+        return json_rows(items)
+    name = (file.filename or "").lower()
+    if name.endswith(".xlsx"):
+        return table_rows(xlsx_rows(upload_copy(file.stream)))
+    if name.endswith(".csv") or name.endswith(".txt"):
+        return table_rows(csv_rows(upload_copy(file.stream)))
+    raise ValueError("Недопустимый формат")
+
+@app.route("/api/regulation-check-batch", methods=["POST"])
+def api_regulation_check_batch():
+    fmt = request.args.get("format", "ndjson")
+    try:
+        rows = batch_input()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    def verdicts():
+        for n, (code, voltage) in enumerate(rows, 1):
+            result = check_regulation(code, voltage)
+            result.update(row=n, code=code, voltage=voltage)
+            yield result
+
+    if fmt == "csv":
+        return Response(stream_with_context(csv_stream(BATCH_COLUMNS, verdicts())), mimetype="text/csv",
+                        headers={"Content-Disposition": "attachment; filename=regulation-check.csv"})
+    return Response(stream_with_context(ndjson_stream(verdicts())), mimetype="application/x-ndjson")
+
+# ---------- МАССОВЫЙ ИМПОРТ ГОСТов ----------
+
+IMPORT_BATCH = 500
+IMPORT_COLUMNS = {
+    "number": ("gost_number", "gost", "number", "номер", "номер госта", "гост"),
+    "mark": ("gost_mark", "mark", "маркировка"),
+    "text": ("gost_text", "text", "текст", "описание", "пункты"),
+}
+TRIS_REFS = (("yuqori", 1, 2, 3), ("past", 4, 5, 6))   # (уровень, тип, номер, пункты) в «Tris Shablon.xlsx»
+
+def validate_gost(number, mark, text):
+    if not isinstance(number, str) or not number.strip():
+        return "Неверный номер ГОСТ"
+    if len(number) > 200:
+        return "Слишком длинный номер ГОСТ"
+    if not isinstance(mark, str) or not isinstance(text, str):
+        return "Маркировка и текст должны быть строками"
+    return None
+
+def table_records(rows):
+    """(row, (number, mark, text, append), error) из CSV/XLSX с заголовком.
+
+    Шаблон TRIS («Tris Shablon.xlsx»: показатель, тип/номер/пункты нормативного
+    документа) узнаётся по заголовку: каждая ссылка строки становится
+    пунктом ГОСТа «<тип> <номер>», пункты одного ГОСТа собираются в один текст.
+    """
+    rows = iter(rows)
+    head = [cell_str(c).lower() for c in next(rows, ())]
+    tris = any("hujjat raqami" in h for h in head)
+    cols = {field: next((i for i, h in enumerate(head) if h in names), None)
+            for field, names in IMPORT_COLUMNS.items()}
+    if not tris and cols["number"] is None:
+        yield 1, None, "Не найдена колонка с номером ГОСТа"
+        return
+    for n, row in enumerate(rows, 2):
+        cells = [cell_str(c) for c in row]
+        if not any(cells):
+            continue
+        cell = lambda i: cells[i] if i is not None and i < len(cells) else ""
+        if tris:
+            refs = [(cell(t), cell(num), cell(par)) for _, t, num, par in TRIS_REFS if cell(num)]
+            if not refs:
+                yield n, None, "Нет номера нормативного документа"
+            for kind, number, clauses in refs:
+                line = " ".join(x for x in (clauses, cell(0)) if x)
+                yield n, (f"{kind} {number}".strip(), "", line, True), None
+            continue
+        number, mark, text = cell(cols["number"]), cell(cols["mark"]), cell(cols["text"])
+        error = validate_gost(number, mark, text)
+        yield n, None if error else (number.strip(), mark, text, False), error
+
+def ndjson_records(stream):
+    for n, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            yield n, None, "Некорректный JSON"
+            continue
+        if not isinstance(obj, dict):
+            yield n, None, "Ожидается JSON-объект"
+            continue
+        number = obj.get("gost_number", obj.get("number", obj.get("gost", "")))
+        mark = obj.get("gost_mark", obj.get("mark", ""))
+        text = obj.get("gost_text", obj.get("text", ""))
+        error = validate_gost(number, mark, text)
+        yield n, None if error else (number.strip(), mark, text, False), error
+
+def import_records(stream, fmt):
+    """Записи из потока в формате ndjson / csv / xlsx; поток закрывается по окончании."""
+    if fmt == "xlsx":
+        return table_records(xlsx_rows(stream))
+    if fmt == "csv":
+        return table_records(csv_rows(stream))
+
+    def ndjson():
+        try:
+            yield from ndjson_records(stream)
+        finally:
+            stream.close()
+    return ndjson()
+
+def import_format(filename, default="ndjson"):
+    ext = os.path.splitext(filename or "")[1].lower().lstrip(".")
+    return {"xlsx": "xlsx", "csv": "csv", "txt": "csv", "ndjson": "ndjson", "jsonl": "ndjson"}.get(ext, default)
+
+def import_gosts(records, batch_size=IMPORT_BATCH):
+    """Upsert пачками через put_many; отдаёт события: ошибки строк и прогресс по пачкам."""
+    stats = {"rows": 0, "imported": 0, "errors": 0, "batches": 0}
+    batch = {}
+
+    def flush():
+        gost_store.put_many(list(batch.items()))
+        stats["imported"] += len(batch)
+        stats["batches"] += 1
+        batch.clear()
+        return dict(stats, progress=True)
+
+    last_row = None
+    records = iter(records)
+    while True:
+        try:
+            n, rec, error = next(records)
+        except StopIteration:
+            break
+        except (ValueError, csv.Error, zipfile.BadZipFile, KeyError) as e:
+            # файл испорчен дальше начала: уже прочитанное сохраняется, ответ не обрывается
+            stats["errors"] += 1
+            yield {"row": last_row, "error": f"Файл прочитан не до конца: {e}"}
+            break
+        if n != last_row:       # одна строка TRIS даёт до двух ссылок
+            last_row = n
+            stats["rows"] += 1
+        if error:
+            stats["errors"] += 1
+            yield {"row": n, "error": error}
+            continue
+        number, mark, text, append = rec
+        current = batch.get(number)
+        if current is None:
+            existing = gost_store.get().get(number)
+            if isinstance(existing, dict):
+                current = dict(existing)
+            else:
+                current = {"text": existing, "mark": ""} if existing else {}
+        if append:
+            # ссылка из шаблона TRIS дополняет запись, а не заменяет её;
+            # повторный импорт того же файла не дублирует строки
+            lines = current.get("text", "").split("\n") if current.get("text") else []
+            if text not in lines:
+                current["text"] = "\n".join(lines + [text])
+            current.setdefault("mark", "")
+            if mark:
+                current["mark"] = mark
+        else:
+            current.update(text=text, mark=mark)
+        batch[number] = current
+        if len(batch) >= batch_size:
+            yield flush()
+    if batch:
+        yield flush()
+    yield dict(stats, done=True)
+
+@app.route("/api/import-gosts", methods=["POST"])
+def api_import_gosts():
+    """Файл (multipart «file») или тело запроса в NDJSON; ответ — NDJSON с прогрессом."""
+    file = request.files.get("file")
+    if file is not None:
+        fmt = request.args.get("format") or import_format(file.filename)
+        src = upload_copy(file.stream)
+    else:
+        fmt = request.args.get("format", "ndjson")
+        src = upload_copy(request.stream)
+    try:
+        records = import_records(src, fmt)     # XLSX и CSV проверяются здесь, до ответа
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
 
-    if not query.isdigit() or len(query) < 6:
-        result["reason"] = "Введите корректный код ТН ВЭД"
-        return jsonify(result)
+    return Response(stream_with_context(ndjson_stream(import_gosts(records))), mimetype="application/x-ndjson")
 
-    if query not in reg.get("tnved_codes", []):
-        result["reason"] = "Код ТН ВЭД не входит в область действия регламента"
-        return jsonify(result)
+def import_file(path):
+    """CLI: python gost_search_app_v3.py import <файл.ndjson|.csv|.xlsx>"""
+    for event in import_gosts(import_records(open(path, "rb"), import_format(path))):
+        print(json.dumps(event, ensure_ascii=False))
 
-    if voltage.isdigit():
-        v = int(voltage)
-        ac_min = reg["voltage_limits"]["ac_min_v"]
-        ac_max = reg["voltage_limits"]["ac_max_v"]
-        if v < ac_min or v > ac_max:
-            result["reason"] = "Напряжение вне диапазона регламента"
-            return jsonify(result)
+# ---------- ВЫГРУЗКА ДАННЫХ ----------
 
-    result["applies"] = True
-    result["reason"] = "Подпадает под технический регламент"
-    result["regulation"] = reg.get("name", "")
-    result["forms"] = reg.get("conformity_forms", "")
-    return jsonify(result)
+EXPORT_COLUMNS = {
+    "gost": ["gost_number", "mark", "text", "image"],
+    "tnved": ["code", "name", "sector", "object_code", "standards"],
+}
+EXPORT_CHUNK = 64 * 1024
+
+def export_gost_rows(data, keys):
+    for gost in keys:
+        info = data[gost]
+        if isinstance(info, dict):
+            yield {"gost_number": gost, "mark": info.get("mark", ""),
+                   "text": info.get("text", ""), "image": info.get("image", "")}
+        else:
+            yield {"gost_number": gost, "mark": "", "text": str(info), "image": ""}
+
+def export_tnved_rows(data, keys):
+    for code in keys:
+        yield {"code": code, **data[code]}
+
+def export_snapshot(dataset, q):
+    """Снимок словаря и ключи для выгрузки, взятые под одной блокировкой.
+
+    Хранилища подменяют словарь целиком при каждой записи (copy-on-write),
+    поэтому снимок не меняется, пока выгрузка стримится, а правки не ждут её.
+    """
+    if dataset == "gost":
+        with gost_store.lock:
+            data = gost_snapshot()
+            keys = [g for g, _ in gost_index.search(q)] if q else sorted(data)
+        return data, keys
+    with tnved_store.lock:
+        data = tnved_snapshot()
+        code = tnved_code(q)
+        if not q:
+            keys = list(tnved_index.codes)
+        elif code:
+            _, keys = tnved_index.prefix(code, len(data))
+        else:
+            _, keys = tnved_index.name_search(q, len(data))
+    return data, keys
+
+def xlsx_stream(columns, rows):
+    """XLSX в режиме write_only (строки сразу уходят во временный файл), затем файл кусками."""
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(columns)
+    for row in rows:
+        ws.append(["; ".join(v) if isinstance(v, list) else v for v in (row.get(c, "") for c in columns)])
+    with tempfile.TemporaryFile() as out:
+        wb.save(out)
+        out.seek(0)
+        while True:
+            chunk = out.read(EXPORT_CHUNK)
+            if not chunk:
+                break
+            yield chunk
+
+def gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)    # 31 — заголовок gzip
+    for chunk in chunks:
+        data = z.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+@app.route("/api/export/<dataset>")
+def api_export(dataset):
+    """Выгрузка gost|tnved в ndjson/csv/xlsx; q — поиск (для ТН ВЭД цифры — префикс кода).
+
+    gzip — если клиент прислал Accept-Encoding: gzip (xlsx уже сжат).
+    """
+    if dataset not in EXPORT_COLUMNS:
+        return jsonify({"success": False, "error": "Неизвестный набор данных"}), 404
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv", "xlsx"):
+        return jsonify({"success": False, "error": "Формат: ndjson, csv или xlsx"}), 400
+    if fmt == "xlsx":
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            return jsonify({"success": False, "error": "Для XLSX нужен пакет openpyxl"}), 400
+    q = normalize_query(request.args.get("q", ""))
+    data, keys = export_snapshot(dataset, q)
+    rows = (export_gost_rows if dataset == "gost" else export_tnved_rows)(data, keys)
+    columns = EXPORT_COLUMNS[dataset]
+    body, mimetype = {
+        "ndjson": (lambda: ndjson_stream(rows), "application/x-ndjson"),
+        "csv": (lambda: csv_stream(columns, rows), "text/csv"),
+        "xlsx": (lambda: xlsx_stream(columns, rows),
+                 "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    }[fmt]
+    body = body()
+    headers = {"Content-Disposition": f"attachment; filename={dataset}.{fmt}",
+               "X-Total-Count": str(len(keys)), "Vary": "Accept-Encoding"}
+    if fmt != "xlsx" and "gzip" in request.accept_encodings:
+        body = gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+# ---------- ПРОДАКШН: WSGI-ФАБРИКА ----------
+
+def warm_up():
+    """Загружает все датасеты и строит все индексы заранее."""
+    similar_index.prepare(gost_snapshot(), tnved_snapshot())
+    regulation_snapshot()
+    for index, store in ((gost_suggest, gost_store), (tnved_suggest, tnved_store)):
+        with store.lock:
+            data = store.get()
+            if index.dirty:
+                index.rebuild(data)
+
+def create_app():
+    """WSGI-фабрика (gunicorn.conf.py, waitress).
+
+    При preload_app вызывается в мастере gunicorn до fork: данные и индексы
+    строятся один раз, а воркеры получают их копией при записи (copy-on-write).
+    gc.freeze() убирает прогретые объекты из обхода сборщика мусора, чтобы он
+    не трогал (и не копировал) их страницы в каждом воркере.
+    """
+    warm_up()
+    gc.freeze()
+    return app
+
+def _after_fork_in_child():
+    global profiles_lock, search_pool, image_pool
+    for store in (gost_store, tnved_store, regulation_store, regulations):
+        store.after_fork()
+    query_cache.lock = threading.Lock()
+    similar_index.lock = threading.Lock()
+    metrics.lock = threading.Lock()
+    metrics.counters, metrics.histograms = {}, {}     # у каждого воркера свои ряды
+    profiles_lock = threading.Lock()
+    single_flight.lock = threading.Lock()
+    single_flight.calls = {}
+    admission.__init__(HEAVY_SLOTS, HEAVY_WAIT, HEAVY_QUEUE)
+    search_pool = image_pool = None     # потоки пулов родителя в дочерний процесс не переходят
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def serve():
+    """Многопоточный сервер без fork (Windows): pip install waitress."""
+    from waitress import serve as waitress_serve
+    waitress_serve(create_app(), host="0.0.0.0", port=int(os.environ.get("PORT", 5000)),
+                   threads=int(os.environ.get("WAITRESS_THREADS", 8)))
+
+def migrate(db_path=None):
+    """Однократный перенос JSON-файлов в SQLite (gost.db или db_path)."""
+    global DB_FILE
+    DB_FILE = db_path or DB_FILE
+    targets = make_stores("sqlite")
+    for src, dst in zip((DATA_FILE, TNVED_FILE, REGULATION_FILE), targets):
+        data = JsonStore(src).get()
+        dst.save(data)
+        print(f"{src} -> {DB_FILE}:{dst.table} ({len(data)})")
+
+def export(db_path=None):
+    """Обратная выгрузка SQLite -> JSON-файлы."""
+    global DB_FILE
+    DB_FILE = db_path or DB_FILE
+    for src, dst in zip(make_stores("sqlite"), (DATA_FILE, TNVED_FILE, REGULATION_FILE)):
+        data = src.get()
+        JsonStore(dst).save(data)
+        print(f"{DB_FILE}:{src.table} -> {dst} ({len(data)})")
+
+@app.route("/api/suggest")
+@conditional("g", "t")
+def api_suggest():
+    q = request.args.get("q", "")
+    k = int_arg("k", 8, 1, SUGGEST_TOP)
+    src = request.args.get("src", "")
+    found = []
+    for name, index, store in (("gost", gost_suggest, gost_store), ("tnved", tnved_suggest, tnved_store)):
+        if src and src != name:
+            continue
+        with store.lock:
+            data = store.get()
+            if index.dirty:
+                index.rebuild(data)
+            found.extend(index.query(q, k))
+    found.sort(key=lambda e: e[1])
+    return jsonify([{"label": e[2], "kind": e[3], "value": e[4]} for e in found[:k]])
+
+@app.route("/api/crossref")
+@conditional("g", "t")
+def api_crossref():
+    """?gost=<номер> -> коды ТН ВЭД; ?code=<код> -> стандарты и записи базы."""
+    gost = request.args.get("gost", "").strip()
+    code = tnved_code(request.args.get("code", "").strip())
+    data = tnved_snapshot()
+    gost_snapshot()
+    with gost_store.lock:
+        if gost:
+            codes = crossref.codes_for(gost)
+            return jsonify({"gost": gost, "tnved": [
+                {"code": c, "name": data[c].get("name", "")} for c in codes]})
+        if code:
+            return jsonify({"code": code, "standards": crossref.standards_for(code)})
+    return jsonify({"error": "Укажите gost или code"}), 400
+
+@app.route("/api/similar/<gost>")
+@conditional("g", "t")
+def api_similar(gost):
+    """Похожие ГОСТы и коды ТН ВЭД по TF-IDF; src=gost|tnved ограничивает выдачу."""
+    k = int_arg("k", SIMILAR_TOP, 1, SIMILAR_MAX_TOP)
+    kinds = {"gost": "g", "tnved": "t"}.get(request.args.get("src", ""), "gt")
+    gosts, tnved = gost_snapshot(), tnved_snapshot()
+    if gost not in gosts:
+        return jsonify({"success": False, "error": "ГОСТ не найден"}), 404
+    key = ("similar", gost, k, kinds, gost_store.tag(), tnved_store.tag())
+    hit = query_cache.get(key)
+    if hit is None:
+        def compute():
+            items = []
+            for (kind, doc), score in similar_to([gost], k, kinds)[0]:
+                if kind == "g":
+                    info = gosts.get(doc)
+                    title = info.get("mark", "") if isinstance(info, dict) else ""
+                    items.append({"kind": "gost", "value": doc, "title": title, "score": score})
+                else:
+                    items.append({"kind": "tnved", "value": doc,
+                                  "title": tnved.get(doc, {}).get("name", ""), "score": score})
+            with timed("render"):
+                return query_cache.put(key, "gt", app.json.dumps(items), len(items))
+        hit = compute_once(key, compute)
+    return cached_response(hit)
+
+@app.route("/api/duplicates")
+@conditional("g")
+def api_duplicates():
+    """Кластеры почти-дубликатов по всей базе, крупные первыми."""
+    min_size = int_arg("min_size", 2, 2)
+    gost_snapshot()
+    with gost_store.lock:
+        clusters = [c for c in gost_dups.clusters() if len(c) >= min_size]
+    return jsonify([{"size": len(c), "gosts": c} for c in clusters])
+
+# ---------- ИНСТРУМЕНТИРОВАНИЕ ЗАПРОСОВ ----------
+
+PROFILE_TOKEN = os.environ.get("GOST_PROFILE_TOKEN", "")   # пусто — профайлер выключен
+PROFILE_INTERVAL = 0.001
+PROFILE_KEEP = 20
+
+
+class Sampler:
+    """Сэмплирующий профайлер одного потока: раз в interval снимает его стек
+    через sys._current_frames() и считает одинаковые стеки (формат collapsed
+    для flamegraph.pl / speedscope)."""
+
+    def __init__(self, ident, interval=PROFILE_INTERVAL):
+        self.ident = ident
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.ident)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+    def collapsed(self):
+        return "".join(f"{k} {n}\n" for k, n in sorted(self.stacks.items(), key=lambda kv: -kv[1]))
+
+
+profiles = OrderedDict()     # id -> Sampler, последние PROFILE_KEEP
+profiles_lock = threading.Lock()
+
+def profiling_allowed():
+    token = request.headers.get("X-Profile", "")
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+def endpoint_label():
+    return request.url_rule.endpoint if request.url_rule else "unmatched"
+
+@app.before_request
+def _metrics_start():
+    g.started = time.perf_counter()
+    g.timings = {}
+    if profiling_allowed():
+        g.profile = Sampler(threading.get_ident()).start()
+
+@app.after_request
+def _metrics_finish(resp):
+    endpoint = endpoint_label()
+    elapsed = time.perf_counter() - g.get("started", time.perf_counter())
+    metrics.observe("gost_request_seconds", elapsed, endpoint=endpoint)
+    metrics.inc("gost_requests_total", endpoint=endpoint, status=resp.status_code)
+    metrics.inc("gost_request_bytes_total", request.content_length or 0, endpoint=endpoint)
+    if resp.is_streamed:
+        resp.response = _count_bytes(resp.response, endpoint)
+    else:
+        metrics.inc("gost_response_bytes_total", resp.calculate_content_length() or 0, endpoint=endpoint)
+    timings = dict(g.get("timings") or {}, total=elapsed)
+    resp.headers["Server-Timing"] = ", ".join(f"{k};dur={v * 1000:.2f}" for k, v in timings.items())
+    profile = g.get("profile")
+    if profile is not None:
+        resp.headers["X-Profile-Id"] = f"{id(profile):x}"
+    return resp
+
+def _count_bytes(chunks, endpoint):
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        metrics.inc("gost_response_bytes_total", sent, endpoint=endpoint)
+
+@app.teardown_request
+def _profile_finish(exc):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return
+    profile.stop()      # для стриминга teardown — после отдачи последнего куска
+    with profiles_lock:
+        profiles[f"{id(profile):x}"] = profile
+        while len(profiles) > PROFILE_KEEP:
+            profiles.popitem(last=False)
+
+@app.route("/debug/profile/<pid>")
+def debug_profile(pid):
+    """Стеки профиля запроса, снятого с заголовком X-Profile: <GOST_PROFILE_TOKEN>."""
+    if not profiling_allowed():
+        return jsonify({"success": False, "error": "Профилирование выключено"}), 403
+    with profiles_lock:
+        profile = profiles.get(pid)
+    if profile is None:
+        return jsonify({"success": False, "error": "Профиль не найден"}), 404
+    return Response(profile.collapsed(), mimetype="text/plain",
+                    headers={"X-Profile-Samples": str(profile.samples)})
+
+@app.route("/metrics")
+def prometheus_metrics():
+    cache = query_cache.stats()
+    gauges = [
+        ("gost_query_cache_hits_total", {}, cache["hits"]),
+        ("gost_query_cache_misses_total", {}, cache["misses"]),
+        ("gost_query_cache_hit_ratio", {}, cache["hit_ratio"]),
+        ("gost_query_cache_bytes", {}, cache["bytes"]),
+        ("gost_admission_waiting", {}, admission.waiting),
+    ]
+    for name, store in (("gost", gost_store), ("tnved", tnved_store)):
+        if store.loaded:
+            gauges.append(("gost_records", {"dataset": name}, len(store.data)))
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/cache-stats")
+def api_cache_stats():
+    return jsonify(query_cache.stats())
 
 if __name__ == "__main__":
-    import os
+    # python gost_search_app_v3.py [serve | migrate|export [gost.db] | import <файл>]
+    commands = {"serve": serve, "migrate": migrate, "export": export, "import": import_file}
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](*sys.argv[2:3])
+        sys.exit(0)
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
 
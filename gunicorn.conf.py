@@ -0,0 +1,15 @@
+# gunicorn -c gunicorn.conf.py
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+wsgi_app = "gost_search_app_v3:create_app()"
+
+# данные и индексы строятся в мастере один раз, воркеры делят их copy-on-write
+preload_app = True
+
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+keepalive = 5
@@ -0,0 +1,20 @@
+import json, os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def gosts(tmp_path, monkeypatch):
+    """Приложение на своей копии gost_data.json: хранилища открыты по относительным путям."""
+    import gost_search_app_v3 as app
+
+    def seed(data):
+        with open(tmp_path / app.DATA_FILE, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        return app.app.test_client()
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app.gost_store, "compactor", object())     # без фонового потока сжатия
+    return seed
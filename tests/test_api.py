@@ -0,0 +1,36 @@
+# Запись через HTTP: импорт и правка ГОСТов не теряют уже сохранённые поля.
+import gost_search_app_v3 as app
+
+TEXT = "1 Область применения\nНастоящий стандарт распространяется на изделия."
+TRIS_HEAD = "Ko'rsatkich,Yuqori turi,Yuqori hujjat raqami,Yuqori bandlari,Past turi,Past hujjat raqami,Past bandlari\n"
+
+
+def test_tris_import_keeps_existing_record(gosts):
+    client = gosts({"ГОСТ 3940-2004": {"text": TEXT, "mark": "Маркировка транспортная"}})
+    body = (TRIS_HEAD + "Маркировка,ГОСТ,3940-2004,п. 4.28,,,\n").encode("utf-8")
+    for _ in range(2):      # повторный импорт того же файла ничего не дублирует
+        resp = client.post("/api/import-gosts?format=csv", data=body, content_type="text/csv")
+        assert resp.status_code == 200
+        assert b'"errors": 0' in resp.get_data()
+    info = app.load_data()["ГОСТ 3940-2004"]
+    assert info["mark"] == "Маркировка транспортная"
+    assert info["text"] == TEXT + "\nп. 4.28 Маркировка"
+
+
+def test_tris_import_creates_missing_record(gosts):
+    client = gosts({})
+    body = (TRIS_HEAD + "Маркировка,ГОСТ,1-80,п. 1,ГОСТ,2-81,п. 2\nУпаковка,ГОСТ,1-80,п. 3,,,\n").encode("utf-8")
+    client.post("/api/import-gosts?format=csv", data=body, content_type="text/csv").get_data()
+    data = app.load_data()
+    assert data["ГОСТ 1-80"] == {"text": "п. 1 Маркировка\nп. 3 Упаковка", "mark": ""}
+    assert data["ГОСТ 2-81"] == {"text": "п. 2 Маркировка", "mark": ""}
+
+
+def test_update_keeps_image(gosts):
+    images = {"image": "/media/ab-preview.jpg", "thumb": "/media/ab-thumb.jpg", "image_full": "/media/ab-full.jpg"}
+    client = gosts({"ГОСТ 1-80": dict(images, text="старый текст", mark="старая")})
+    resp = client.post("/api/update-gost", json={"number": "ГОСТ 1-80", "mark": "новая", "text": "новый текст"})
+    assert resp.get_json()["ok"] is True
+    assert app.load_data()["ГОСТ 1-80"] == dict(images, text="новый текст", mark="новая")
+    item = client.get("/api/get-gost/" + "ГОСТ 1-80").get_json()
+    assert item["thumb"] == images["thumb"]
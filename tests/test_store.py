@@ -0,0 +1,140 @@
+# JsonStore: журнал, докатка между процессами, сжатие и двоичный снимок.
+import json, multiprocessing, os
+
+import pytest
+
+import gost_search_app_v3 as app
+
+WRITERS = 4
+PUTS = 150
+
+needs_fork = pytest.mark.skipif(app.fcntl is None or "fork" not in multiprocessing.get_all_start_methods(),
+                                reason="нужны flock и fork")
+
+
+def record(w, i):
+    return {"text": f"пункт {w}.{i}", "mark": "Маркировка", "refs": [w, i, None, True, 1.5]}
+
+
+def writer(path, w, compact_at):
+    """Воркер: свой JsonStore на общем файле, записи, удаления и одно сжатие посередине."""
+    store = app.JsonStore(path)
+    for i in range(PUTS):
+        store.put(f"w{w}-{i}", record(w, i))
+        if i % 10 == 9:
+            store.put(f"w{w}-{i - 5}", None)
+        if i == compact_at:
+            store.compact()
+
+
+def expected():
+    data = {}
+    for w in range(WRITERS):
+        for i in range(PUTS):
+            data[f"w{w}-{i}"] = record(w, i)
+            if i % 10 == 9:
+                del data[f"w{w}-{i - 5}"]
+    return data
+
+
+@needs_fork
+def test_multiprocess_put_compact_round_trip(tmp_path):
+    path = str(tmp_path / "gost_data.json")
+    app.JsonStore(path).save({"base": {"text": "исходная запись", "mark": ""}})
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=writer, args=(path, w, 40 + 30 * w)) for w in range(WRITERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+        assert p.exitcode == 0
+    want = dict(expected(), base={"text": "исходная запись", "mark": ""})
+
+    # новый процесс видит снимок + журнал
+    assert app.JsonStore(path).get() == want
+
+    store = app.JsonStore(path)
+    store.compact()
+    assert not os.path.exists(store.journal_path)
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == want
+    assert app.read_snapshot(store.snapshot_path, store._stat(path)) == want
+    assert app.JsonStore(path).get() == want
+
+
+def test_compaction_carries_over_tail(tmp_path, monkeypatch):
+    """Запись, дописанная другим воркером во время сериализации, остаётся в журнале."""
+    path = str(tmp_path / "gost_data.json")
+    store, other = app.JsonStore(path), app.JsonStore(path)
+    store.put_many([(f"k{i}", {"text": str(i)}) for i in range(5)])
+    dump = json.dump
+
+    def dump_then_write(data, f, **kw):
+        dump(data, f, **kw)
+        monkeypatch.setattr(app.json, "dump", dump)
+        other.put("late", {"text": "во время сжатия"})
+
+    monkeypatch.setattr(app.json, "dump", dump_then_write)
+    store.compact()
+
+    with open(path, encoding="utf-8") as f:
+        assert "late" not in json.load(f)
+    with open(store.journal_path, "rb") as f:
+        assert [json.loads(line)["key"] for line in f] == ["late"]
+    want = dict({f"k{i}": {"text": str(i)} for i in range(5)}, late={"text": "во время сжатия"})
+    assert store.get() == want
+    assert app.JsonStore(path).get() == want
+
+
+def test_replay_skips_unfinished_line(tmp_path):
+    path = str(tmp_path / "gost_data.json")
+    store = app.JsonStore(path)
+    store.put("a", {"text": "1"})
+    with open(store.journal_path, "ab") as f:
+        f.write(b'{"op": "put", "key": "b", "value": {"text": "2"}')
+    assert app.JsonStore(path).get() == {"a": {"text": "1"}}
+    with open(store.journal_path, "ab") as f:
+        f.write(b"}\n")
+    assert store.get() == {"a": {"text": "1"}, "b": {"text": "2"}}
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "data.snap")
+    shared = ["ГОСТ 1-80", "ГОСТ 2-81"]
+    data = {
+        "8418102001": {"name": "Холодильники", "standards": shared, "sector": "Y.01."},
+        "8418108001": {"name": "Холодильники", "standards": list(shared), "sector": "Y.01."},
+        "пусто": {},
+        "литералы": [0, -1, 2 ** 40, 1.25, True, False, None, "", [], [[]]],
+        "строка": "значение не словарь",
+        "ключ с \u0000 и эмодзи 🙂": {"вложенный": {"список": ["a", {"b": "c"}]}},
+    }
+    app.write_snapshot(path, data, (123, 456))
+
+    got = app.read_snapshot(path, (123, 456))
+    assert got == data
+    assert list(got) == sorted(data)
+    # одинаковые значения становятся одним объектом
+    assert got["8418102001"] is got["8418108001"]
+
+    assert app.read_snapshot(path, (123, 457)) is None      # JSON изменился после снимка
+    assert app.read_snapshot(str(tmp_path / "нет.snap"), (123, 456)) is None
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 8)
+    assert app.read_snapshot(path, (123, 456)) is None
+
+
+def test_read_only_directory(tmp_path, monkeypatch):
+    """Файл блокировки не создать (каталог только для чтения) — чтение всё равно работает."""
+    path = str(tmp_path / "gost_data.json")
+    app.JsonStore(path).save({"a": {"text": "1"}})
+    os.remove(path + ".lock")
+    real_open = os.open
+
+    def no_lock(name, *args, **kw):
+        if name.endswith(".lock"):
+            raise PermissionError(13, "Read-only file system", name)
+        return real_open(name, *args, **kw)
+
+    monkeypatch.setattr(os, "open", no_lock)
+    assert app.JsonStore(path).get() == {"a": {"text": "1"}}